@@ -1,14 +1,43 @@
 import os
+import json
 import logging
+from contextlib import closing
 import requests
 import pandas as pd
 from datetime import datetime, timedelta
 from psycopg2.extras import execute_values
 from airflow import AirflowException
+from airflow.exceptions import AirflowSkipException
 import airflow
 from airflow import DAG
-from airflow.operators.python import PythonOperator
+from airflow.operators.python import PythonOperator, ShortCircuitOperator
+from airflow.utils.state import State
+from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
 from airflow.providers.snowflake.operators.snowflake import SnowflakeOperator
+from bde_at3_sql import (
+    listings_full_refresh,
+    table_tasks,
+    table_task_id,
+    shared_table_tasks,
+    city_table_tasks,
+    staging_sources,
+    stage_fingerprint_sql,
+    changed_stage_files_sql,
+    query_unmatched_names,
+    query_fact_clustering_information,
+    query_referential_integrity,
+    referential_integrity_checks,
+    datamart_tables,
+    query_datamart_content_hash,
+    query_datamart_export,
+    default_city,
+    cities,
+    city_table,
+    city_sql,
+    city_listings_folder,
+)
+from bde_at3_validation import validate_listings, quarantine_file_name
+from bde_at3_export import export_datamart_tables, city_export_dir
 
 
 #########################################################
@@ -19,6 +48,67 @@ from airflow.providers.snowflake.operators.snowflake import SnowflakeOperator
 # Connection variables
 snowflake_conn_id = "snowflake_conn_id"
 
+# Number of statements listed in the run-level summary of the slowest statements
+slowest_statements_reported = 10
+
+# The data folder of the Composer bucket behind @stage_gcp_listings, and where the validation results are written
+listings_data_dir = os.environ.get("BDE_LISTINGS_DATA_DIR", "/home/airflow/gcs/data/listings")
+validation_output_dir = os.environ.get("BDE_VALIDATION_OUTPUT_DIR", "/home/airflow/gcs/data/validation")
+
+# The listings folders of the other cities sit next to the default city's, behind their @stage_gcp_listings_<city>
+listings_data_dirs = {
+    city: listings_data_dir if city == default_city
+    else os.path.join(os.path.dirname(listings_data_dir), city_listings_folder(city))
+    for city in cities
+}
+
+# Airflow pool that caps the tasks running statements on the warehouse at once across all the cities,
+# created with `airflow pools set snowflake_warehouse <slots> "Snowflake warehouse slots"`
+snowflake_pool = os.environ.get("BDE_SNOWFLAKE_POOL", "snowflake_warehouse")
+
+# One slot pool of the dim_date merges of the cities, created with `airflow pools set dim_date 1 "dim_date merges"`.
+# At READ COMMITTED, two merges of the same new month at once would both insert it, and a duplicate month row
+# would double the fact rows of that month, so the cities merge their months into the shared dim_date one at a time
+dim_date_pool = os.environ.get("BDE_DIM_DATE_POOL", "dim_date")
+table_pools = {city_table("dim_date", city): dim_date_pool for city in cities}
+
+# Warehouse and session settings of every stage, the warehouses are created in part_1.sql. A lookup load
+# of a few hundred rows runs on an x-small warehouse instead of paying for the warehouse of the fact build
+execution_profiles = {
+    "lookup": {"warehouse": "bde_xsmall_wh", "statement_timeout_seconds": 600},
+    "staging": {"warehouse": "bde_small_wh", "statement_timeout_seconds": 1800},
+    "dimension": {"warehouse": "bde_small_wh", "statement_timeout_seconds": 1800},
+    "fact": {"warehouse": "bde_medium_wh", "statement_timeout_seconds": 3600},
+    "datamart": {"warehouse": "bde_small_wh", "statement_timeout_seconds": 1800},
+    "report": {"warehouse": "bde_xsmall_wh", "statement_timeout_seconds": 600},
+}
+
+# Tables of the table_tasks spec in each stage, the per city tables take the profile of their stage
+stage_tables = {
+    "lookup": list(shared_table_tasks),
+    "staging": ["staging_listings", "listings_pending_months"],
+    "dimension": ["dim_listings", "dim_host", "dim_date"],
+    "fact": ["fact_listings", "fact_listings_wide"],
+    "datamart": [table for table in city_table_tasks if table.startswith(("kpi_", "datamart_"))],
+}
+table_stages = {
+    city_table(table, city): stage for stage, tables in stage_tables.items() for table in tables for city in cities
+}
+
+# Small sequential tables loaded in one task and one Snowflake session instead of a task and a connection each.
+# A table of the group is skipped when all of its upstream tables were skipped. The lookup staging tables
+# are not grouped, so they keep loading concurrently and retrying on their own
+session_groups = {
+    "lookup_dimensions": ["dim_lga", "dim_suburb"],
+}
+
+# Number of unmatched neighbourhood and lga names listed in the log
+unmatched_names_reported = 50
+
+# Where the datamart tables are exported for the BI tools, as gzip csv or zstd Parquet files
+export_output_dir = os.environ.get("BDE_EXPORT_DIR", "/home/airflow/gcs/data/exports")
+export_format = os.environ.get("BDE_EXPORT_FORMAT", "csv")
+
 ########################################################
 #
 #   DAG Settings
@@ -27,20 +117,21 @@ snowflake_conn_id = "snowflake_conn_id"
 
 dag_default_args = {
     'owner': 'Naeer',
-    'start_date': datetime.now(),
+    'start_date': datetime(2021, 5, 1),
     'retries': 2,
     'retry_delay': timedelta(minutes=5),
     'depends_on_past': False,
     'wait_for_downstream': False,
+    'pool': snowflake_pool,
 }
 
 dag = DAG(
     dag_id='bde_at_3',
     default_args=dag_default_args,
-    schedule_interval=None,
+    schedule_interval='@daily',
     catchup=False,
     max_active_runs=1,
-    concurrency=5
+    concurrency=5 * len(cities)
 )
 
 
@@ -50,446 +141,285 @@ dag = DAG(
 #
 #########################################################
 
-query_refresh_dim_suburb = f"""
-alter external table raw.nsw_lga_suburb refresh;
-
--- Transferring the data from raw.nsw_lga_suburb to staging as a table
-create or replace table staging.nsw_lga_suburb as
-select 
-    value:c1::varchar as lga_name
-    , value:c2::varchar as suburb_name
-from raw.nsw_lga_suburb;
-
--- Create an intermediate table to get the mapping of the lga code to the suburb
-create or replace table staging.lga_code_suburb as
-select staging.nsw_lga_code.lga_code, staging.nsw_lga_code.lga_name, staging.nsw_lga_suburb.suburb_name
-from staging.nsw_lga_suburb
-left join staging.nsw_lga_code on lower(staging.nsw_lga_suburb.lga_name) = lower(staging.nsw_lga_code.lga_name);
-
--- Create a suburb dimension table with suburb_id, lg_code and suburb_name
-create or replace table datawarehouse.dim_suburb as
-select 
-row_number() over (order by count(*) desc) as suburb_id, 
-lga_code, suburb_name
-from staging.lga_code_suburb
-group by lga_code, suburb_name;
-"""
-
-query_refresh_dim_lga = f"""
-alter external table raw.nsw_lga_code refresh;
-
--- Transferring the data from raw.nsw_lga_code to staging as a table
-create or replace table staging.nsw_lga_code as
-select 
-    value:c1::int as lga_code
-    , value:c2::varchar as lga_name
-from raw.nsw_lga_code;
-
-alter external table raw.go1_census refresh;
-
--- Transferring the data from raw.go1_census to staging as a table 
-create or replace table staging.go1_census as
-select
-    value:c1::varchar as lga_code
-    , value:c2::int as Tot_P_M
-    , value:c3::int as Tot_P_F
-    , value:c4::int as Tot_P_P
-    , value:c5::int as Age_0_4_yr_M
-    , value:c6::int as Age_0_4_yr_F
-    , value:c7::int as Age_0_4_yr_P
-    , value:c8::int as Age_5_14_yr_M
-    , value:c9::int as Age_5_14_yr_F
-    , value:c10::int as Age_5_14_yr_P
-    , value:c11::int as Age_15_19_yr_M
-    , value:c12::int as Age_15_19_yr_F
-    , value:c13::int as Age_15_19_yr_P
-    , value:c14::int as Age_20_24_yr_M
-    , value:c15::int as Age_20_24_yr_F
-    , value:c16::int as Age_20_24_yr_P
-    , value:c17::int as Age_25_34_yr_M
-    , value:c18::int as Age_25_34_yr_F
-    , value:c19::int as Age_25_34_yr_P
-    , value:c20::int as Age_35_44_yr_M
-    , value:c21::int as Age_35_44_yr_F
-    , value:c22::int as Age_35_44_yr_P
-    , value:c23::int as Age_45_54_yr_M
-    , value:c24::int as Age_45_54_yr_F
-    , value:c25::int as Age_45_54_yr_P
-    , value:c26::int as Age_55_64_yr_M
-    , value:c27::int as Age_55_64_yr_F
-    , value:c28::int as Age_55_64_yr_P
-    , value:c29::int as Age_65_74_yr_M
-    , value:c30::int as Age_65_74_yr_F
-    , value:c31::int as Age_65_74_yr_P
-    , value:c32::int as Age_75_84_yr_M
-    , value:c33::int as Age_75_84_yr_F
-    , value:c34::int as Age_75_84_yr_P
-    , value:c35::int as Age_85ov_M
-    , value:c36::int as Age_85ov_F
-    , value:c37::int as Age_85ov_P
-    , value:c38::int as Counted_Census_Night_home_M
-    , value:c39::int as Counted_Census_Night_home_F
-    , value:c40::int as Counted_Census_Night_home_P
-    , value:c41::int as Count_Census_Nt_Ewhere_Aust_M
-    , value:c42::int as Count_Census_Nt_Ewhere_Aust_F
-    , value:c43::int as Count_Census_Nt_Ewhere_Aust_P
-from raw.go1_census;
-
--- Adding a column to go1 census table with clean lga code
-create or replace table staging.go1_census as
-select substr(lga_code, 4)::int as clean_lga_code, * from staging.go1_census;
-
-alter external table raw.go2_census refresh;
-
--- Transferring the data from raw.go2_census to staging as a table 
-create or replace table staging.go2_census as
-select
-    value:c1::varchar as lga_code
-    , value:c2::int as median_age_people
-    , value:c3::int as median_mortgage_repay_monthly
-    , value:c4::int as median_tot_prsnl_inc_weekly
-    , value:c5::int as median_rent_weekly
-    , value:c6::int as median_tot_fam_inc_weekly
-    , value:c7::int as average_num_psns_per_bedroom
-    , value:c8::int as median_tot_hhd_inc_weekly
-    , value:c9::int as average_household_size
-from raw.go2_census;
-
--- Adding a column to go2 census table with clean lga code
-create or replace table staging.go2_census as
-select substr(lga_code, 4)::int as clean_lga_code, * from staging.go2_census;
-
--- Create a lga dimension table
-create or replace table datawarehouse.dim_lga as 
-select 
-staging.nsw_lga_code.lga_code,
-staging.nsw_lga_code.lga_name,
-staging.go1_census.tot_p_m,
-staging.go1_census.tot_p_f,
-staging.go1_census.tot_p_p,
-staging.go1_census.Age_0_4_yr_M,
-staging.go1_census.Age_0_4_yr_F,
-staging.go1_census.Age_0_4_yr_P,
-staging.go1_census.Age_5_14_yr_M,
-staging.go1_census.Age_5_14_yr_F,
-staging.go1_census.Age_5_14_yr_P,
-staging.go1_census.Age_15_19_yr_M,
-staging.go1_census.Age_15_19_yr_F,
-staging.go1_census.Age_15_19_yr_P,
-staging.go1_census.Age_20_24_yr_M,
-staging.go1_census.Age_20_24_yr_F,
-staging.go1_census.Age_20_24_yr_P,
-staging.go1_census.Age_25_34_yr_M,
-staging.go1_census.Age_25_34_yr_F,
-staging.go1_census.Age_25_34_yr_P,
-staging.go2_census.median_age_people,
-staging.go2_census.median_mortgage_repay_monthly,
-staging.go2_census.median_tot_prsnl_inc_weekly,
-staging.go2_census.median_rent_weekly,
-staging.go2_census.median_tot_fam_inc_weekly,
-staging.go2_census.average_num_psns_per_bedroom,
-staging.go2_census.median_tot_hhd_inc_weekly,
-staging.go2_census.average_household_size
-from staging.nsw_lga_code
-left join staging.go1_census on staging.nsw_lga_code.lga_code = staging.go1_census.clean_lga_code
-left join staging.go2_census on staging.nsw_lga_code.lga_code = staging.go2_census.clean_lga_code
-;
-"""
-
-query_refresh_dim_listings = f"""
-alter external table raw.listings refresh;
-
--- Transferring the data from raw.listings to staging as a table 
-create or replace table staging.listings as
-select 
-    value:c1::int as listing_id
-    , value:c2::bigint as scrape_id
-    , value:c3::date as scrape_date
-    , value:c4::int as host_id
-    , value:c5::varchar as host_name
-    , value:c6::varchar as host_since
-    , value:c7::boolean as host_is_superhost
-    , value:c8::varchar as host_neighbourhood
-    , value:c9::varchar as listing_neighbourhood
-    , value:c10::varchar as property_type
-    , value:c11::varchar as room_type
-    , value:c12::int as accomodates
-    , value:c13::int as price
-    , value:c14::boolean as has_availability
-    , value:c15::int as availability_30
-    , value:c16::int as number_reviews
-    , value:c17::int as review_scores_ratings
-    , value:c18::int as review_scores_accuracy
-    , value:c19::int as review_scores_cleanliness
-    , value:c20::int as review_scores_checkin
-    , value:c21::int as review_scores_communication
-    , value:c22::int as review_scores_value
-    , split_part(substr(metadata$filename, 15), '.', 0)::varchar as month_year
-from raw.listings;
-
--- Adding host_since_date and month_year_date columns with the correct data type and format
-create or replace table staging.listings as
-select *, 
-to_date(host_since, 'DD/MM/YYYY')::date as host_since_date,
-to_date('01' || '_' || month_year, 'DD_MM_YYYY')::date as month_year_date
-from staging.listings;
-
--- Drop host_since and month_year column from listings table
-alter table staging.listings
-drop column host_since, month_year;
-
--- Rename host_since_date column to host_since 
-alter table staging.listings
-rename column host_since_date to host_since;
-
--- Rename month_year_date column to month_year 
-alter table staging.listings
-rename column month_year_date to month_year;
-
--- Create listings dimension table
-create or replace table datawarehouse.dim_listings as
-select 
-row_number() over (order by count(*) desc) as auto_gen_listing_id,
-listing_id as original_listing_id, property_type, room_type, accomodates, has_availability
-from staging.listings
-group by original_listing_id, property_type, room_type, accomodates, has_availability;
-"""
-
-query_refresh_dim_host = f"""
--- Create host dimension table
-create or replace table datawarehouse.dim_host as
-select 
-row_number() over (order by count(*) desc) as auto_gen_host_id,
-host_id as original_host_id, host_name, host_is_superhost, host_since
-from staging.listings
-group by original_host_id, host_name, host_is_superhost, host_since;
-"""
-
-query_refresh_dim_date = f"""
--- Create a dimension table for date 
-create or replace table datawarehouse.dim_date as
-select
-row_number() over (order by count(*) desc) as date_id,
-month_year
-from staging.listings
-group by month_year;
-"""
-
-query_refresh_fact_listings = f"""
--- Create intermediary table by merging the listings table with listings, host, lga, date and suburb dimension tables
-create or replace table datawarehouse.temp_listings_lga_suburb as
-select
-datawarehouse.dim_listings.auto_gen_listing_id,
-datawarehouse.dim_listings.original_listing_id,
-staging.listings.scrape_id,
-staging.listings.scrape_date,
-datawarehouse.dim_host.auto_gen_host_id,
-datawarehouse.dim_host.original_host_id,
-staging.listings.host_name,
-staging.listings.host_since,
-staging.listings.host_is_superhost,
-staging.listings.host_neighbourhood,
-staging.listings.listing_neighbourhood,
-staging.listings.property_type,
-staging.listings.room_type,
-staging.listings.accomodates,
-staging.listings.price,
-staging.listings.has_availability,
-staging.listings.availability_30,
-staging.listings.number_reviews,
-staging.listings.review_scores_ratings,
-staging.listings.review_scores_accuracy,
-staging.listings.review_scores_cleanliness,
-staging.listings.review_scores_checkin,
-staging.listings.review_scores_communication,
-staging.listings.review_scores_value,
-staging.nsw_lga_code.lga_code,
-staging.nsw_lga_code.lga_name,
-datawarehouse.dim_suburb.suburb_id,
-datawarehouse.dim_suburb.suburb_name,
-datawarehouse.dim_date.date_id,
-datawarehouse.dim_date.month_year
-from staging.listings
-left join staging.nsw_lga_code on staging.listings.listing_neighbourhood = staging.nsw_lga_code.lga_name
-left join datawarehouse.dim_suburb on lower(staging.listings.host_neighbourhood) = lower(datawarehouse.dim_suburb.suburb_name)
-left join datawarehouse.dim_date on staging.listings.month_year = datawarehouse.dim_date.month_year
-left join datawarehouse.dim_listings on staging.listings.listing_id = datawarehouse.dim_listings.original_listing_id and staging.listings.property_type = datawarehouse.dim_listings.property_type and staging.listings.room_type = datawarehouse.dim_listings.room_type and staging.listings.accomodates = datawarehouse.dim_listings.accomodates and staging.listings.has_availability = datawarehouse.dim_listings.has_availability
-left join datawarehouse.dim_host on staging.listings.host_id = datawarehouse.dim_host.original_host_id and staging.listings.host_name = datawarehouse.dim_host.host_name and staging.listings.host_is_superhost = datawarehouse.dim_host.host_is_superhost and staging.listings.host_since = datawarehouse.dim_host.host_since;
-
--- Create fact table
-create or replace table datawarehouse.fact_listings as 
+query_statement_metrics = """
 select
-auto_gen_listing_id, 
-auto_gen_host_id, 
-lga_code, 
-suburb_id, 
-date_id, 
-price, 
-availability_30,
-number_reviews, 
-review_scores_ratings
-from datawarehouse.temp_listings_lga_suburb;
-
----- Adding primary key constraints to the dimension tables
-alter table datawarehouse.dim_date add primary key (date_id);
-alter table datawarehouse.dim_host add primary key (auto_gen_host_id);
-alter table datawarehouse.dim_lga add primary key (lga_code);
-alter table datawarehouse.dim_listings add primary key(auto_gen_listing_id);
-alter table datawarehouse.dim_suburb add primary key(suburb_id);
-
--- Adding foreign key constraint for auto_gen_listing_id to fact_listings table
-alter table datawarehouse.fact_listings
-add constraint fact_listings_fk_dim_listings
-foreign key (auto_gen_listing_id)
-references datawarehouse.dim_listings (auto_gen_listing_id);
-
--- Adding foreign key constraint for auto_gen_host_id to fact_listings table
-alter table datawarehouse.fact_listings
-add constraint fact_listings_fk_dim_host
-foreign key (auto_gen_host_id)
-references datawarehouse.dim_host (auto_gen_host_id);
-
--- Adding foreign key constraint for lga_code to fact_listings table
-alter table datawarehouse.fact_listings
-add constraint fact_listings_fk_dim_lga
-foreign key (lga_code)
-references datawarehouse.dim_lga (lga_code);
-
--- Adding foreign key constraint for suburb_id to fact_listings table
-alter table datawarehouse.fact_listings
-add constraint fact_listings_fk_dim_suburb
-foreign key (suburb_id)
-references datawarehouse.dim_suburb (suburb_id);
-
--- Adding foreign key constraint for date_id to fact_listings table
-alter table datawarehouse.fact_listings
-add constraint fact_listings_fk_dim_date
-foreign key (date_id)
-references datawarehouse.dim_date (date_id);
+    query_id
+    , query_text
+    , warehouse_name
+    , warehouse_size
+    , execution_status
+    , total_elapsed_time / 1000 as elapsed_seconds
+    , bytes_scanned
+    , partitions_scanned
+    , partitions_total
+    , rows_produced
+    , bytes_spilled_to_local_storage
+    , bytes_spilled_to_remote_storage
+    , queued_provisioning_time / 1000 as queued_provisioning_seconds
+    , queued_overload_time / 1000 as queued_overload_seconds
+    , query_tag
+from table(information_schema.query_history_by_user(
+    end_time_range_start => dateadd('hour', -12, current_timestamp())
+    , result_limit => 10000
+))
+where query_id in ({query_ids})
 """
 
-query_datamart_listing_neighbourhood = f"""
--- Create a listing_neighbourhood table for datamart schema grouping by listing_neighbourhood and month_year
-create or replace table datamart.dm_listing_neighbourhood as 
-with listing_neighbourhood_stats as (
-    select
-    lga_name as listing_neighbourhood, 
-    month_year,
-    count(case when has_availability = TRUE then 1 END) as total_active_listings,
-    count(case when has_availability = FALSE then 1 END) as total_inactive_listings,
-    count(case when has_availability = TRUE or has_availability = FALSE then 1 END) as total_listings,
-    min(case when has_availability = TRUE then price END) as min_price,
-    max(case when has_availability = TRUE then price END) as max_price,
-    approx_percentile(case when has_availability = TRUE then price END, 0.5) as median_price,
-    avg(case when has_availability = TRUE then price END) as avg_price,
-    count(distinct(original_host_id)) as distinct_hosts,
-    count(distinct(case when host_is_superhost = TRUE then original_host_id END)) as distinct_superhosts,
-    avg(case when has_availability = TRUE then review_scores_ratings END) as avg_review_scores_ratings,
-    sum(case when has_availability = TRUE then (30-availability_30) END) as total_stays,
-    avg(case when has_availability = TRUE then ((30-availability_30)*price) END) as                                 avg_estimated_revenue_per_active_listing
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
-    left join datawarehouse.dim_date on datawarehouse.fact_listings.date_id = datawarehouse.dim_date.date_id
-    left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    group by listing_neighbourhood, month_year
-)
-select 
-listing_neighbourhood,
-month_year,
-case when total_listings = 0 then null else (total_active_listings/total_listings)*100 END as active_listings_rate,
-min_price,
-max_price,
-median_price,
-avg_price,
-distinct_hosts,
-case when distinct_hosts = 0 then null else (distinct_superhosts/distinct_hosts)*100 END as superhost_rate,
-avg_review_scores_ratings,
-case when lag(total_active_listings) over(partition by listing_neighbourhood order by month_year) = 0 then null else ((total_active_listings - lag(total_active_listings) over(partition by listing_neighbourhood order by month_year))/lag(total_active_listings) over(partition by listing_neighbourhood order by month_year))*100 END as      per_change_active_listings,
-case when lag(total_inactive_listings) over(partition by listing_neighbourhood order by month_year) = 0 then null else
-((total_inactive_listings - lag(total_inactive_listings) over(partition by listing_neighbourhood order by month_year))/lag(total_inactive_listings) over(partition by listing_neighbourhood order by month_year))*100 END as per_change_inactive_listings,
-total_stays,
-avg_estimated_revenue_per_active_listing
-from listing_neighbourhood_stats
-;
-"""
 
-query_refresh_datamart_property_type = f"""
--- Create a property_type table for datamart schema grouping by property_type, room_type, accomodates, month_year
-create or replace table datamart.dm_property_type as 
-with property_type_stats as (
-    select
-    property_type,
-    room_type,
-    accomodates,
-    month_year,
-    count(case when has_availability = TRUE then 1 END) as total_active_listings,
-    count(case when has_availability = FALSE then 1 END) as total_inactive_listings,
-    count(case when has_availability = TRUE or has_availability = FALSE then 1 END) as total_listings,
-    min(case when has_availability = TRUE then price END) as min_price,
-    max(case when has_availability = TRUE then price END) as max_price,
-    approx_percentile(case when has_availability = TRUE then price END, 0.5) as median_price,
-    avg(case when has_availability = TRUE then price END) as avg_price,
-    count(distinct(original_host_id)) as distinct_hosts,
-    count(distinct(case when host_is_superhost = TRUE then original_host_id END)) as distinct_superhosts,
-    avg(case when has_availability = TRUE then review_scores_ratings END) as avg_review_scores_ratings,
-    sum(case when has_availability = TRUE then (30-availability_30) END) as total_stays,
-    avg(case when has_availability = TRUE then ((30-availability_30)*price) END) as                                 avg_estimated_revenue_per_active_listing
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
-    left join datawarehouse.dim_date on datawarehouse.fact_listings.date_id = datawarehouse.dim_date.date_id
-    left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    group by property_type, room_type, accomodates, month_year
-)
-select 
-property_type,
-room_type,
-accomodates,
-month_year,
-case when total_listings = 0 then null else (total_active_listings/total_listings)*100 END as active_listings_rate,
-min_price,
-max_price,
-median_price,
-avg_price,
-distinct_hosts,
-case when distinct_hosts = 0 then null else (distinct_superhosts/distinct_hosts)*100 END as superhost_rate,
-avg_review_scores_ratings,
-case when lag(total_active_listings) over(partition by property_type, room_type, accomodates order by month_year) = 0 then null else ((total_active_listings - lag(total_active_listings) over(partition by property_type, room_type, accomodates order by month_year))/lag(total_active_listings) over(partition by property_type, room_type, accomodates order by month_year))*100 END as per_change_active_listings,
-case when lag(total_inactive_listings) over(partition by property_type, room_type, accomodates order by month_year) = 0 then null else ((total_inactive_listings - lag(total_inactive_listings) over(partition by property_type, room_type, accomodates order by month_year))/lag(total_inactive_listings) over(partition by property_type, room_type, accomodates order by month_year))*100 END as per_change_inactive_listings,
-total_stays,
-avg_estimated_revenue_per_active_listing
-from property_type_stats
-;
-"""
+def statement_label(query_text):
+    for line in query_text.splitlines():
+        if line.strip() and not line.strip().startswith("--"):
+            return line.strip()[:120]
+    return ""
+
+
+def session_parameters(stage, task_id):
+    # Tags every statement with its task, so the query history of a run can be filtered by task
+    return {
+        "QUERY_TAG": f"bde_at_3.{task_id}",
+        "STATEMENT_TIMEOUT_IN_SECONDS": execution_profiles[stage]["statement_timeout_seconds"],
+    }
+
+
+def profiled_hook(stage, context):
+    # Hook of a python task, connected to the warehouse of its stage with the session settings of the stage
+    return SnowflakeHook(
+        snowflake_conn_id=snowflake_conn_id,
+        warehouse=execution_profiles[stage]["warehouse"],
+        session_parameters=session_parameters(stage, context["ti"].task_id),
+    )
+
+
+def run_in_session(conn, sql, query_ids):
+    # Runs the statements of sql on an open connection and records their query ids for the metrics
+    cursors = conn.execute_string(sql)
+    query_ids.extend(cursor.sfqid for cursor in cursors)
+    return cursors
+
+
+class ProfiledSnowflakeOperator(SnowflakeOperator):
+    """SnowflakeOperator that publishes the execution metrics of every statement it ran."""
+
+    def execute(self, context):
+        query_ids = []
+        with closing(self.get_db_hook().get_conn()) as conn:
+            run_in_session(conn, self.sql, query_ids)
+            self.publish_query_metrics(context, conn, query_ids)
+
+    def publish_query_metrics(self, context, conn, query_ids):
+        # Read on the connection of the task, so no second connection is opened on another warehouse
+        if not query_ids:
+            return
+
+        with conn.cursor() as cursor:
+            cursor.execute(query_statement_metrics.format(query_ids=", ".join(["%s"] * len(query_ids))), query_ids)
+            rows = cursor.fetchall()
+        history = {row[0]: row for row in rows}
+        metrics = []
+        for statement_number, query_id in enumerate(query_ids, 1):
+            if query_id not in history:
+                continue
+            (query_id, query_text, warehouse_name, warehouse_size, execution_status, elapsed_seconds, bytes_scanned,
+             partitions_scanned, partitions_total, rows_produced, spilled_local, spilled_remote,
+             queued_provisioning_seconds, queued_overload_seconds, query_tag) = history[query_id]
+            statement_metrics = {
+                "task_id": self.task_id,
+                "statement_number": statement_number,
+                "statement": statement_label(query_text),
+                "query_id": query_id,
+                "warehouse_name": warehouse_name,
+                "warehouse_size": warehouse_size,
+                "execution_status": execution_status,
+                "elapsed_seconds": float(elapsed_seconds or 0),
+                "bytes_scanned": int(bytes_scanned or 0),
+                "partitions_scanned": int(partitions_scanned or 0),
+                "partitions_total": int(partitions_total or 0),
+                "partitions_pruned": int((partitions_total or 0) - (partitions_scanned or 0)),
+                "rows_produced": int(rows_produced or 0),
+                "bytes_spilled_to_local_storage": int(spilled_local or 0),
+                "bytes_spilled_to_remote_storage": int(spilled_remote or 0),
+                # Time spent waiting for a suspended warehouse to resume, and for a busy one to free up
+                "queued_provisioning_seconds": float(queued_provisioning_seconds or 0),
+                "queued_overload_seconds": float(queued_overload_seconds or 0),
+                "query_tag": query_tag,
+            }
+            logging.info("query_metrics %s", json.dumps(statement_metrics))
+            metrics.append(statement_metrics)
+
+        task_metrics = {
+            "task_id": self.task_id,
+            "statements": len(metrics),
+            "warehouses": sorted({m["warehouse_name"] for m in metrics if m["warehouse_name"]}),
+            "elapsed_seconds": sum(m["elapsed_seconds"] for m in metrics),
+            "queued_provisioning_seconds": sum(m["queued_provisioning_seconds"] for m in metrics),
+            "queued_overload_seconds": sum(m["queued_overload_seconds"] for m in metrics),
+        }
+        logging.info("task_query_metrics %s", json.dumps(task_metrics))
+        context["ti"].xcom_push(key="query_metrics", value=metrics)
+
+
+class SnowflakeSessionOperator(ProfiledSnowflakeOperator):
+    """Loads several tables of the table_tasks spec in spec order on one connection, skipping the unchanged ones."""
+
+    def __init__(self, *, tables, **kwargs):
+        super().__init__(sql="\n".join(table_tasks[table][0] for table in tables), **kwargs)
+        self.tables = tables
+
+    def inputs_skipped(self, context, table, skipped):
+        # True when every upstream table was skipped: in this session for the tables of the session,
+        # by their own task for the others
+        upstream_tables = table_tasks[table][1]
+        return bool(upstream_tables) and all(
+            upstream in skipped if upstream in self.tables
+            else context["dag_run"].get_task_instance(table_task_id(upstream)).state == State.SKIPPED
+            for upstream in upstream_tables
+        )
+
+    def execute(self, context):
+        query_ids, skipped = [], set()
+        with closing(self.get_db_hook().get_conn()) as conn:
+            for table in self.tables:
+                if self.inputs_skipped(context, table, skipped):
+                    logging.info("%s: skipped, its inputs are unchanged", table)
+                    skipped.add(table)
+                    continue
+                run_in_session(conn, table_tasks[table][0], query_ids)
+                logging.info("%s: loaded", table)
+            self.publish_query_metrics(context, conn, query_ids)
+        if skipped.issuperset(self.tables):
+            # Downstream tables follow their trigger rule, as with a short-circuited staging task
+            raise AirflowSkipException("The inputs of every table of the session are unchanged")
+
+
+def summarise_query_metrics(**context):
+    # Rank the statements of every task of this run by elapsed time
+    dag_run = context["dag_run"]
+    metrics = []
+    for task_instance in dag_run.get_task_instances():
+        task_metrics = context["ti"].xcom_pull(task_ids=task_instance.task_id, key="query_metrics")
+        metrics.extend(task_metrics or [])
+
+    slowest = sorted(metrics, key=lambda m: m["elapsed_seconds"], reverse=True)[:slowest_statements_reported]
+    summary = {
+        "statements": len(metrics),
+        "elapsed_seconds": sum(m["elapsed_seconds"] for m in metrics),
+        "bytes_scanned": sum(m["bytes_scanned"] for m in metrics),
+        "bytes_spilled": sum(m["bytes_spilled_to_local_storage"] + m["bytes_spilled_to_remote_storage"] for m in metrics),
+        "queued_provisioning_seconds": sum(m["queued_provisioning_seconds"] for m in metrics),
+        "queued_provisioning_seconds_by_warehouse": {
+            warehouse: sum(m["queued_provisioning_seconds"] for m in metrics if m["warehouse_name"] == warehouse)
+            for warehouse in sorted({m["warehouse_name"] for m in metrics if m["warehouse_name"]})
+        },
+        "slowest_statements": slowest,
+    }
+    logging.info("run_query_summary %s", json.dumps(summary))
+    for rank, m in enumerate(slowest, 1):
+        logging.info("%d. %.1fs %s #%d %s (query id %s)", rank, m["elapsed_seconds"], m["task_id"],
+                     m["statement_number"], m["statement"], m["query_id"])
+    return summary
+
+
+def validate_listings_files(city, **context):
+    # Fail the run before any warehouse compute when a listings file has values that staging cannot cast
+    output_dir = city_export_dir(validation_output_dir, city)
+    summary = validate_listings(listings_data_dirs[city], output_dir)
+    logging.info("listings_validation %s", json.dumps({key: value for key, value in summary.items() if key != "files"}))
+    for file in summary["files"]:
+        if file["errors"]:
+            logging.error("%s: %s (bad values by column: %s)", file["file_name"], "; ".join(file["errors"]),
+                          json.dumps(file["bad_values"]))
+    if summary["invalid_files"]:
+        raise AirflowException(
+            f"{len(summary['invalid_files'])} listings files failed validation, see "
+            f"{os.path.join(output_dir, quarantine_file_name)}"
+        )
+    return {key: value for key, value in summary.items() if key != "files"}
+
+
+def stage_files_changed(table, city, **context):
+    # Returns False, skipping the staging task of raw.<table>, when its files are unchanged since the last load
+    if table == "listings" and listings_full_refresh:
+        return True
+    hook = profiled_hook("lookup", context)
+    hook.run(stage_fingerprint_sql(table, city))
+    changed_files = hook.get_first(changed_stage_files_sql(table, city))[0]
+    logging.info("%s: %d files added, changed or removed since the last load", city_sql(f"raw.{table}", city),
+                 changed_files)
+    return changed_files > 0
+
+
+def report_unmatched_names(city, **context):
+    # Log the names of the loaded months that did not resolve to an lga or a suburb
+    hook = profiled_hook("report", context)
+    rows = hook.get_records(city_sql(query_unmatched_names, city))
+    report = {}
+    for name_kind, name, row_count in rows:
+        report.setdefault(name_kind, {"names": 0, "rows": 0})
+        report[name_kind]["names"] += 1
+        report[name_kind]["rows"] += int(row_count)
+    logging.info("unmatched_names %s", json.dumps(report))
+    for name_kind, name, row_count in rows[:unmatched_names_reported]:
+        logging.warning("Unmatched %s %r in %d rows", name_kind, name, row_count)
+    return report
+
+
+def validate_referential_integrity(city, **context):
+    # The constraints are declared NOT ENFORCED with RELY, so fail the run when the loaded fact rows break them
+    hook = profiled_hook("report", context)
+    counts = hook.get_first(city_sql(query_referential_integrity, city))
+    violations = dict(zip(referential_integrity_checks, (int(count) for count in counts)))
+    logging.info("referential_integrity %s", json.dumps(violations))
+    failed = {check: count for check, count in violations.items() if count}
+    if failed:
+        raise AirflowException(f"Constraints violated by the loaded fact rows: {json.dumps(failed)}")
+    return violations
+
+
+def report_fact_clustering(city, **context):
+    # Log how well the fact table micro-partitions are clustered on (date_id, lga_code) after the load.
+    # An average depth close to 1 means that a month and lga scoped query reads few partitions
+    hook = profiled_hook("report", context)
+    clustering = json.loads(hook.get_first(city_sql(query_fact_clustering_information, city))[0])
+    report = {
+        "cluster_by_keys": clustering.get("cluster_by_keys"),
+        "total_partition_count": clustering.get("total_partition_count"),
+        "total_constant_partition_count": clustering.get("total_constant_partition_count"),
+        "average_overlaps": clustering.get("average_overlaps"),
+        "average_depth": clustering.get("average_depth"),
+        "partition_depth_histogram": clustering.get("partition_depth_histogram"),
+    }
+    logging.info("fact_listings_clustering %s", json.dumps(report))
+    return report
+
+
+def export_datamarts(city, **context):
+    # Stream the changed datamart tables out of Snowflake as Arrow batches, the unchanged ones are not fetched
+    hook = profiled_hook("report", context)
+    conn = hook.get_conn()
+
+    def content_hash(table):
+        with conn.cursor() as cursor:
+            cursor.execute(city_sql(query_datamart_content_hash.format(table=table), city))
+            return cursor.fetchone()
+
+    def record_batches(table):
+        with conn.cursor() as cursor:
+            keys = ", ".join(datamart_tables[table])
+            cursor.execute(city_sql(query_datamart_export.format(table=table, keys=keys), city))
+            if cursor.rowcount == 0:
+                # No batches for an empty table, an empty Arrow table still carries the schema of the file
+                yield cursor.fetch_arrow_all(force_return_table=True)
+            else:
+                yield from cursor.fetch_arrow_batches()
+
+    try:
+        exported = export_datamart_tables(content_hash, record_batches, city_export_dir(export_output_dir, city),
+                                          export_format)
+    finally:
+        conn.close()
+    logging.info("datamart_export %s", json.dumps(exported))
+    return exported
 
-query_refresh_datamart_host_neighbourhood = f"""
--- Create a host_neighbourhood table for datamart schema grouping by host_neighbourhood_lga, month_year
-create or replace table datamart.dm_host_neighbourhood as
-with host_neighbourhood_stats as (
-    select 
-    lga_name as host_neighbourhood_lga,
-    month_year,
-    count(distinct(original_host_id)) as distinct_hosts,
-    sum((30 - availability_30)*price) as estimated_revenue,
-    sum(case when has_availability = TRUE then ((30 - availability_30)*price) END) as estimated_revenue_active_listing
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
-    left join datawarehouse.dim_date on datawarehouse.fact_listings.date_id = datawarehouse.dim_date.date_id
-    left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    left join datawarehouse.dim_suburb on datawarehouse.fact_listings.suburb_id = datawarehouse.dim_suburb.suburb_id
-    group by host_neighbourhood_lga, month_year
-)
-select 
-host_neighbourhood_lga,
-month_year,
-distinct_hosts,
-estimated_revenue,
-estimated_revenue_active_listing/distinct_hosts as estimated_revenue_per_host
-from host_neighbourhood_stats
-;
-"""
 
 #########################################################
 #
@@ -498,75 +428,125 @@ from host_neighbourhood_stats
 #########################################################
 
 
-refresh_dim_lga = SnowflakeOperator(
-    task_id='refresh_dim_lga_task',
-    sql=query_refresh_dim_lga,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
-
-refresh_dim_listings = SnowflakeOperator(
-    task_id='refresh_dim_listings_task',
-    sql=query_refresh_dim_listings,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
-
-refresh_dim_suburb = SnowflakeOperator(
-    task_id='refresh_dim_suburb_task',
-    sql=query_refresh_dim_suburb,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
-
-refresh_dim_host = SnowflakeOperator(
-    task_id='refresh_dim_host_task',
-    sql=query_refresh_dim_host,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
-
-refresh_dim_date = SnowflakeOperator(
-    task_id='refresh_dim_date_task',
-    sql=query_refresh_dim_date,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
-
-refresh_fact_listings = SnowflakeOperator(
-    task_id='refresh_fact_listings_task',
-    sql=query_refresh_fact_listings,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
-
-refresh_fact_datamart_listing_neighbourhood = SnowflakeOperator(
-    task_id='refresh_datamart_listing_neighbourhood_task',
-    sql=query_datamart_listing_neighbourhood,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
-
-refresh_datamart_property_type = SnowflakeOperator(
-    task_id='refresh_datamart_property_type_task',
-    sql=query_refresh_datamart_property_type,
-    snowflake_conn_id=snowflake_conn_id,
-    dag=dag
-)
+# One operator per table of the table_tasks spec in bde_at3_sql.py, so that independent tables load
+# concurrently and a failed table is retried on its own. The tables of a session group share one operator.
+# A table runs when at least one of its upstream tables ran, and is skipped when all of them were skipped.
+# Every operator runs on the warehouse of its stage, with the query tag and statement timeout of the stage
+def profiled_operator(operator_class, task_id, stage, upstream_tables, **kwargs):
+    return operator_class(
+        task_id=task_id,
+        snowflake_conn_id=snowflake_conn_id,
+        warehouse=execution_profiles[stage]["warehouse"],
+        session_parameters=session_parameters(stage, task_id),
+        trigger_rule='none_failed_min_one_success' if upstream_tables else 'all_success',
+        dag=dag,
+        **kwargs
+    )
+
+
+session_group_tables = {table: group for group, tables in session_groups.items() for table in tables}
+session_operators = {}
+table_operators = {}
+for table, (sql, upstream_tables) in table_tasks.items():
+    group = session_group_tables.get(table)
+    if group in session_operators:
+        table_operators[table] = session_operators[group]
+        continue
+    if group:
+        tables = session_groups[group]
+        upstream_tables = sorted({upstream for member in tables for upstream in table_tasks[member][1]} - set(tables))
+        operator = session_operators[group] = profiled_operator(
+            SnowflakeSessionOperator, table_task_id(group), table_stages[table], upstream_tables, tables=tables
+        )
+    else:
+        operator = profiled_operator(
+            ProfiledSnowflakeOperator, table_task_id(table), table_stages[table], upstream_tables, sql=sql,
+            pool=table_pools.get(table, snowflake_pool)
+        )
+    table_operators[table] = operator
+    for upstream_operator in dict.fromkeys(table_operators[upstream_table] for upstream_table in upstream_tables):
+        upstream_operator >> operator
+
+# The listings files of every city are validated on the Airflow workers, outside of the warehouse pool
+validate_listings_tasks = {
+    city: PythonOperator(
+        task_id=city_table('validate_listings', city) + '_task',
+        python_callable=validate_listings_files,
+        op_kwargs={'city': city},
+        retries=0,
+        pool='default_pool',
+        dag=dag
+    )
+    for city in cities
+}
 
-refresh_datamart_host_neighbourhood = SnowflakeOperator(
-    task_id='refresh_datamart_host_neighbourhood_task',
-    sql=query_refresh_datamart_host_neighbourhood,
-    snowflake_conn_id=snowflake_conn_id,
+# Skip a staging table when the files behind its external table are unchanged. Only the staging task is
+# short-circuited, the tables downstream of it follow their trigger rule.
+# A city's listings check waits for the validation of its files, so a bad listings file fails the city before
+# any warehouse compute.
+for table, (source, city) in staging_sources.items():
+    check_stage_files = ShortCircuitOperator(
+        task_id=f'check_{city_table(source, city)}_files_task',
+        python_callable=stage_files_changed,
+        op_kwargs={'table': source, 'city': city},
+        ignore_downstream_trigger_rules=False,
+        dag=dag
+    )
+    if source == "listings":
+        validate_listings_tasks[city] >> check_stage_files
+    check_stage_files >> table_operators[table]
+
+
+summarise_query_metrics_task = PythonOperator(
+    task_id='summarise_query_metrics_task',
+    python_callable=summarise_query_metrics,
+    trigger_rule='all_done',
     dag=dag
 )
 
 
-refresh_dim_lga >> refresh_dim_suburb
-refresh_dim_listings >> refresh_dim_host
-refresh_dim_listings >> refresh_dim_date
-[refresh_dim_suburb, refresh_dim_host, refresh_dim_date] >> refresh_fact_listings
-refresh_fact_listings >> refresh_fact_datamart_listing_neighbourhood
-refresh_fact_listings >> refresh_datamart_property_type
-refresh_fact_listings >> refresh_datamart_host_neighbourhood
-
+for city in cities:
+    report_unmatched_names_task = PythonOperator(
+        task_id=city_table('report_unmatched_names', city) + '_task',
+        python_callable=report_unmatched_names,
+        op_kwargs={'city': city},
+        dag=dag
+    )
+
+    # Off the critical path: runs next to the wide fact table and the datamart tasks instead of before them
+    validate_referential_integrity_task = PythonOperator(
+        task_id=city_table('validate_referential_integrity', city) + '_task',
+        python_callable=validate_referential_integrity,
+        op_kwargs={'city': city},
+        retries=0,
+        dag=dag
+    )
+
+    report_fact_clustering_task = PythonOperator(
+        task_id=city_table('report_fact_clustering', city) + '_task',
+        python_callable=report_fact_clustering,
+        op_kwargs={'city': city},
+        dag=dag
+    )
+
+    # Runs once the datamarts of this run are refreshed, and is skipped with them when their inputs are unchanged
+    export_datamarts_task = PythonOperator(
+        task_id=city_table('export_datamarts', city) + '_task',
+        python_callable=export_datamarts,
+        op_kwargs={'city': city},
+        trigger_rule='none_failed_min_one_success',
+        dag=dag
+    )
+
+    fact_listings = table_operators[city_table("fact_listings", city)]
+    fact_listings >> report_unmatched_names_task
+    fact_listings >> report_fact_clustering_task
+    fact_listings >> validate_referential_integrity_task
+    # The pending months stay queued when the loaded fact rows break the constraints
+    validate_referential_integrity_task >> table_operators[city_table("listings_pending_months", city)]
+    [
+        table_operators[city_table(table, city)] for table in city_table_tasks if table.startswith("datamart_")
+    ] >> export_datamarts_task
+
+# The tables of a session group share their operator
+list(dict.fromkeys(table_operators.values())) >> summarise_query_metrics_task
@@ -0,0 +1,182 @@
+import os
+import json
+import shutil
+import argparse
+import logging
+import tempfile
+
+import duckdb
+
+from bde_at3_duckdb import LocalWarehouse, default_data_dir
+
+
+#########################################################
+#
+#   Benchmark Settings
+#
+#########################################################
+
+# Roughly the number of Sydney listings in one monthly file
+base_listings_per_month = 36000
+
+# The twelve months of the Sydney feed
+benchmark_months = [
+    "05_2020", "06_2020", "07_2020", "08_2020", "09_2020", "10_2020",
+    "11_2020", "12_2020", "01_2021", "02_2021", "03_2021", "04_2021",
+]
+
+default_scales = [1, 10, 100]
+
+# A task regresses when its wall time, rows scanned or peak memory grows by more than this fraction
+default_threshold = 0.25
+
+# Ignore wall time changes below this many seconds, they are mostly noise
+min_elapsed_seconds = 0.05
+
+# Ignore peak memory changes below this many bytes, memory is sampled while a statement runs
+min_memory_bytes = 16 * 2 ** 20
+
+benchmark_metrics = ("elapsed_seconds", "rows_scanned", "peak_memory_bytes")
+
+
+#########################################################
+#
+#   Synthetic Listings
+#
+#########################################################
+
+def generate_listings(output_dir, scale=1, months=benchmark_months, seed=42, data_dir=default_data_dir):
+    # Writes one MM_YYYY.csv per month with the column layout of the Inside Airbnb extracts.
+    # Listing, host and neighbourhood values are derived from hashes so that runs are reproducible.
+    os.makedirs(output_dir, exist_ok=True)
+    rows = int(base_listings_per_month * scale)
+    hosts = max(1, int(rows / 1.4))
+    conn = duckdb.connect()
+    conn.execute(f"""
+        create table lookups as
+        select
+            (select list(lga_name) from read_csv('{data_dir}/NSW_LGA/NSW_LGA_CODE.csv', header = true, all_varchar = true)) as lga_names,
+            (select list(distinct suburb_name) from read_csv('{data_dir}/NSW_LGA/NSW_LGA_SUBURB.csv', header = true, all_varchar = true)) as suburb_names
+    """)
+    for month_number, month in enumerate(months):
+        mm, yyyy = month.split("_")
+        conn.execute(f"""
+            copy (
+                with listings as (
+                    select
+                        i as listing_id
+                        , (hash(i, {seed}) % {hosts})::bigint as host_id
+                        , (hash(i, {seed}, {month_number}) % 1000000)::bigint as month_hash
+                    from range({rows}) as t(i)
+                )
+                select
+                    listing_id
+                    , {yyyy}{mm}01000000 + {seed} as scrape_id
+                    , '{yyyy}-{mm}-15' as scraped_date
+                    , host_id
+                    , 'Host ' || host_id as host_name
+                    , strftime(date '2009-01-01' + (hash(host_id, {seed}) % 4000)::int, '%d/%m/%Y') as host_since
+                    , case when hash(host_id, {seed}, 'superhost') % 5 = 0 then 't' else 'f' end as host_is_superhost
+                    , suburb_names[(1 + hash(host_id, {seed}, 'suburb') % len(suburb_names))::bigint] as host_neighbourhood
+                    , lga_names[(1 + hash(listing_id, {seed}, 'lga') % 40)::bigint] as listing_neighbourhood
+                    , ['Apartment', 'House', 'Townhouse', 'Villa', 'Guest suite', 'Condominium'][(1 + hash(listing_id, {seed}, 'property') % 6)::bigint] as property_type
+                    , ['Entire home/apt', 'Private room', 'Shared room', 'Hotel room'][(1 + hash(listing_id, {seed}, 'room') % 4)::bigint] as room_type
+                    , 1 + hash(listing_id, {seed}, 'accommodates') % 8 as accommodates
+                    , 40 + month_hash % 400 as price
+                    , case when month_hash % 10 = 0 then 'f' else 't' end as has_availability
+                    , month_hash % 31 as availability_30
+                    , hash(listing_id, {seed}, 'reviews') % 200 + {month_number} as number_of_reviews
+                    , case when hash(listing_id, {seed}, 'rated') % 4 = 0 then null else 60 + hash(listing_id, {seed}, 'rating') % 41 end as review_scores_rating
+                    , 6 + month_hash % 5 as review_scores_accuracy
+                    , 6 + month_hash % 5 as review_scores_cleanliness
+                    , 6 + month_hash % 5 as review_scores_checkin
+                    , 6 + month_hash % 5 as review_scores_communication
+                    , 6 + month_hash % 5 as review_scores_value
+                from listings, lookups
+            ) to '{os.path.join(output_dir, month + ".csv")}' (header)
+        """)
+    conn.close()
+    return rows * len(months)
+
+
+#########################################################
+#
+#   Benchmark Runs
+#
+#########################################################
+
+def run_benchmark(scale, work_dir=None, data_dir=default_data_dir):
+    # Returns {task_id: {elapsed_seconds, rows_scanned, peak_memory_bytes}} for one scale factor
+    temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="bde_at3_benchmark_")
+    listings_dir = os.path.join(work_dir, f"listings_{scale}x")
+    try:
+        total_rows = generate_listings(listings_dir, scale, data_dir=data_dir)
+        logging.info("Generated %d listings rows at %sx", total_rows, scale)
+        warehouse = LocalWarehouse(os.path.join(work_dir, f"benchmark_{scale}x.duckdb"), data_dir, listings_dir, profile=True)
+        results = {}
+        for statement in warehouse.run_dag():
+            task = results.setdefault(statement["task_id"], {metric: 0 for metric in benchmark_metrics})
+            task["elapsed_seconds"] += statement["elapsed_seconds"]
+            task["rows_scanned"] += statement.get("rows_scanned", 0)
+            task["peak_memory_bytes"] = max(task["peak_memory_bytes"], statement.get("peak_memory_bytes", 0))
+        warehouse.conn.close()
+        return results
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def find_regressions(results, baseline, threshold=default_threshold):
+    regressions = []
+    for scale, tasks in results.items():
+        for task_id, metrics in tasks.items():
+            previous = baseline.get(scale, {}).get(task_id)
+            if not previous:
+                continue
+            for metric in benchmark_metrics:
+                before, after = previous.get(metric, 0), metrics[metric]
+                if metric == "elapsed_seconds" and after - before < min_elapsed_seconds:
+                    continue
+                if metric == "peak_memory_bytes" and after - before < min_memory_bytes:
+                    continue
+                if before and after > before * (1 + threshold):
+                    regressions.append((scale, task_id, metric, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bde_at_3 transformations on synthetic listings volumes")
+    parser.add_argument("--scales", type=float, nargs="+", default=default_scales, help="multiples of the current listings volume")
+    parser.add_argument("--baseline", help="JSON file with previous results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=default_threshold, help="allowed relative growth per metric")
+    parser.add_argument("--output", help="write the results to this JSON file, e.g. to use as the next baseline")
+    parser.add_argument("--work-dir", help="directory for the generated listings and DuckDB files")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    results = {}
+    for scale in args.scales:
+        key = f"{scale:g}x"
+        results[key] = run_benchmark(scale, os.path.join(args.work_dir, key) if args.work_dir else None)
+        for task_id, metrics in results[key].items():
+            logging.info("%s %s: %.3fs, %d rows scanned, %.1f MB peak memory", key, task_id,
+                         metrics["elapsed_seconds"], metrics["rows_scanned"], metrics["peak_memory_bytes"] / 2 ** 20)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for scale, task_id, metric, before, after in regressions:
+            logging.error("%s %s regressed on %s: %s -> %s", scale, task_id, metric, before, after)
+        if regressions:
+            raise SystemExit(1)
+        logging.info("No task regressed by more than %.0f%%", args.threshold * 100)
+
+
+if __name__ == "__main__":
+    main()
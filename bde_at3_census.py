@@ -0,0 +1,143 @@
+import os
+import re
+import csv
+import json
+import logging
+import argparse
+import functools
+
+
+#########################################################
+#
+#   Census Settings
+#
+#########################################################
+
+module_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Directory with the census csv files that are uploaded to @stage_gcp_census_lga
+census_dir = os.environ.get("BDE_CENSUS_DIR", os.path.join(module_dir, "data", "Census_LGA"))
+
+# Header and inferred column types of every census file, committed next to the DAG so that parsing the DAG
+# does not read the census files, which are not in the DAG folder on Composer.
+# Rewritten by `python bde_at3_census.py` after a census file or census_packs changes.
+census_schema_path = os.path.join(module_dir, "census_schema.json")
+
+# Census packs loaded into staging and dim_lga: table name -> file name, the header columns used downstream
+# (regular expressions matched against the full column name) and renamed columns.
+# Adding a G03-G09 pack is a new entry here, the external table, staging table and dim_lga columns follow from it.
+census_packs = {
+    "go1_census": {
+        "file_name": "2016Census_G01_NSW_LGA.csv",
+        "used_columns": [r"Tot_P_[MFP]", r"Age_(\d+_\d+_yr|85ov)_[MFP]"],
+        "column_aliases": {},
+    },
+    "go2_census": {
+        "file_name": "2016Census_G02_NSW_LGA.csv",
+        "used_columns": [r".*"],
+        "column_aliases": {"Median_age_persons": "median_age_people"},
+    },
+}
+
+# Rows read after the header to infer the column types
+census_sample_rows = 1000
+
+
+#########################################################
+#
+#   Census Schema
+#
+#########################################################
+
+def infer_column_type(values):
+    # Imported here, bde_at3_sql imports this module to build the census SQL
+    from bde_at3_sql import csv_null_values
+
+    values = [value for value in values if value not in csv_null_values]
+    if all(re.fullmatch(r"-?\d+", value) for value in values):
+        return "int"
+    if all(re.fullmatch(r"-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?", value) for value in values):
+        return "float"
+    return "varchar"
+
+
+def infer_file_columns(file_name):
+    # (header column name, inferred type) for every column of a census file in census_dir
+    with open(os.path.join(census_dir, file_name), newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for _, row in zip(range(census_sample_rows), reader)]
+    return tuple(
+        (name.strip(), infer_column_type([row[i] for row in rows if i < len(row)]))
+        for i, name in enumerate(header)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def census_schema():
+    with open(census_schema_path) as f:
+        return json.load(f)
+
+
+def census_file_columns(file_name):
+    # (header column name, inferred type) for every column of a census file, from the committed schema
+    schema = census_schema()
+    if file_name not in schema:
+        raise KeyError(f"{file_name} is not in {census_schema_path}, run `python bde_at3_census.py` to add it")
+    return tuple((name, column_type) for name, column_type in schema[file_name])
+
+
+def write_census_schema(path=census_schema_path):
+    schema = {pack["file_name"]: infer_file_columns(pack["file_name"]) for pack in census_packs.values()}
+    # One column per line, so that a changed header shows up as a readable diff
+    files = [
+        f"  {json.dumps(file_name)}: [\n" + ",\n".join(f"    {json.dumps(list(column))}" for column in columns) + "\n  ]"
+        for file_name, columns in schema.items()
+    ]
+    with open(path, "w") as f:
+        f.write("{\n" + ",\n".join(files) + "\n}\n")
+    census_schema.cache_clear()
+    return schema
+
+
+def census_columns(table):
+    # (column name, type, position) of the columns of a pack that are used downstream, in file order.
+    # The first column is the LGA_CODE_2016 key, which is always kept as clean_lga_code and lga_code.
+    pack = census_packs[table]
+    used = [re.compile(pattern, re.IGNORECASE) for pattern in pack["used_columns"]]
+    return [
+        (pack["column_aliases"].get(name, name), column_type, position)
+        for position, (name, column_type) in enumerate(census_file_columns(pack["file_name"]), 1)
+        if position > 1 and any(pattern.fullmatch(name) for pattern in used)
+    ]
+
+
+def census_staging_columns(table):
+    # Staging column spec of a pack for select_projection in bde_at3_sql.py
+    return [
+        ("clean_lga_code", "int", "substr(value:c1::varchar, 4)"),
+        ("lga_code", "varchar", "value:c1"),
+    ] + [(name, column_type, f"value:c{position}") for name, column_type, position in census_columns(table)]
+
+
+def dim_lga_census_columns():
+    # (table, column name, type) of the census columns of dim_lga, in pack order
+    return [
+        (table, name, column_type)
+        for table in census_packs
+        for name, column_type, position in census_columns(table)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the census schema that the DAG reads from the census csv headers")
+    parser.add_argument("--output", default=census_schema_path, help="schema JSON file, committed next to the DAG")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    for file_name, columns in write_census_schema(args.output).items():
+        logging.info("%s: %d columns", file_name, len(columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,485 @@
+import os
+import re
+import csv
+import json
+import glob
+import time
+import hashlib
+import tempfile
+import threading
+import argparse
+import logging
+from datetime import datetime, timezone
+
+import duckdb
+
+from bde_at3_census import census_packs
+from bde_at3_sql import (
+    ingest_format,
+    default_city,
+    cities,
+    city_schema,
+    city_table,
+    city_sql,
+    city_listings_folder,
+    table_tasks,
+    table_task_id,
+    staging_sources,
+    stage_fingerprint_sql,
+    changed_stage_files_sql,
+    query_unmatched_names,
+    query_referential_integrity,
+    referential_integrity_checks,
+    datamart_tables,
+    query_datamart_content_hash,
+    query_datamart_export,
+    listings_column_count,
+    csv_null_values,
+    python_date_format,
+)
+from bde_at3_export import batch_rows, export_datamart_tables, city_export_dir
+
+
+#########################################################
+#
+#   Local Settings
+#
+#########################################################
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+default_data_dir = os.path.join(repo_dir, "data")
+
+# External tables of part_1.sql: table name -> (folder under the data directory, file pattern)
+external_tables = {
+    "nsw_lga_code": ("NSW_LGA", "NSW_LGA_CODE.csv"),
+    "nsw_lga_suburb": ("NSW_LGA", "NSW_LGA_SUBURB.csv"),
+    **{table: ("Census_LGA", pack["file_name"]) for table, pack in census_packs.items()},
+    "listings": ("listings", "*.csv"),
+}
+
+# External tables that read Parquet files instead of csv files with BDE_INGEST_FORMAT=parquet
+parquet_tables = ["listings", *census_packs]
+
+# Seconds between two samples of the memory in use while a profiled statement runs
+memory_sample_interval = 0.01
+
+# Committed datamart snapshots and the columns that identify a row
+datamart_snapshots = {
+    table: datamart_tables[table] for table in ("dm_listing_neighbourhood", "dm_property_type", "dm_host_neighbourhood")
+}
+
+
+#########################################################
+#
+#   Snowflake Dialect Shim
+#
+#########################################################
+
+dialect_rewrites = [
+    # Columns of an external table are read from the VARIANT value column in Snowflake
+    (re.compile(r"value:(c\d+)"), r"\1"),
+    (re.compile(r"metadata\$filename"), "metadata_filename"),
+    (re.compile(r"table\(information_schema\.external_table_files\(table_name => '(raw\w*)\.(\w+)'\)\)"), r"\1.\2_files"),
+    # Snowflake treats a split_part index of 0 as 1
+    (re.compile(r"split_part\((.*?), '\.', 0\)"), r"split_part(\1, '.', 1)"),
+    (re.compile(r"\btransient table\b"), "table"),
+    (re.compile(r"\ncluster by \([^)]*\)"), ""),
+    (re.compile(r"current_timestamp\(\)"), "current_timestamp"),
+    (re.compile(r"\btimestamp_ltz\b"), "timestamptz"),
+    (re.compile(r"\bnumber\b"), "bigint"),
+    (re.compile(r"\bhash_agg\(\*\)"), "sum(hash(*columns(*)))"),
+    # Snowflake replaces every match of the pattern, DuckDB only the first one unless asked for all
+    (re.compile(r"regexp_replace\((lower\([^()]*\)), '([^']*)', ' '\)"), r"regexp_replace(\1, '\2', ' ', 'g')"),
+    # DuckDB needs a constant strptime format, so the Snowflake date format is translated here
+    (re.compile(r"\bto_date\((.*?), '([^']*)'\)"),
+     lambda m: f"strptime({m.group(1)}, '{python_date_format(m.group(2))}')::date"),
+    # Snowflake does not enforce primary and foreign keys, so they are dropped rather than enforced locally
+    (re.compile(r" primary key not enforced rely\b"), ""),
+    (re.compile(r"\n\s*, constraint \w+ foreign key \(\w+\) references [\w.]+ \(\w+\) not enforced rely"), ""),
+]
+
+# Sketch states are kept as exact lists locally: HyperLogLog states as the list of distinct values
+# and t-digest states as the list of values, so that local estimates are the exact results
+dialect_macros = """
+create or replace macro approx_percentile(x, fraction) as quantile_cont(x, fraction);
+create or replace macro hll_accumulate(x) as list_distinct(list(x));
+create or replace macro hll_combine(state) as list_distinct(flatten(list(state)));
+create or replace macro hll_estimate(state) as len(state);
+create or replace macro approx_percentile_accumulate(x) as list(x) filter (where x is not null);
+create or replace macro approx_percentile_combine(state) as flatten(list(state));
+create or replace macro approx_percentile_estimate(state, fraction) as list_aggregate(state, 'quantile_cont', fraction);
+"""
+
+refresh_external_table = re.compile(
+    r"^(?:alter external table (raw\w*)\.(\w+) refresh|create external table if not exists (raw)\.(\w+)\b.*)$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Snowflake table maintenance without a DuckDB equivalent, these statements are skipped locally
+snowflake_only_statement = re.compile(r"^alter table [\w.]+ (?:cluster by|add search optimization)\b", re.IGNORECASE)
+
+# DuckDB adds or drops one column per alter table statement
+alter_columns = re.compile(
+    r"^alter table ([\w.]+)\s+(add column if not exists|drop column)\s+(.*)$", re.IGNORECASE | re.DOTALL
+)
+
+
+def schema_city(raw_schema):
+    # City of a raw schema named by city_schema
+    return default_city if raw_schema == "raw" else raw_schema[len("raw_"):]
+
+
+def to_duckdb(statement):
+    for pattern, replacement in dialect_rewrites:
+        statement = pattern.sub(replacement, statement)
+    return statement
+
+
+def sql_list(values):
+    return "[" + ", ".join("'" + value.replace("'", "''") + "'" for value in values) + "]"
+
+
+def split_alter_columns(statement):
+    match = alter_columns.match(statement)
+    if not match:
+        return [statement]
+    return [f"alter table {match.group(1)} {match.group(2)} {column.strip()}" for column in match.group(3).split(",")]
+
+
+def split_statements(sql):
+    statements = []
+    for statement in re.split(r";[ \t]*\n", sql + "\n"):
+        code = "\n".join(line for line in statement.splitlines() if not line.strip().startswith("--"))
+        if code.strip():
+            statements.append(statement.strip())
+    return statements
+
+
+#########################################################
+#
+#   Local Engine
+#
+#########################################################
+
+class StatementMemory:
+    """Peak memory that one statement uses on top of the memory already in use when it starts."""
+
+    def __init__(self, conn):
+        # A second connection to the same database samples duckdb_memory() while the statement runs
+        self.cursor = conn.cursor()
+        self.done = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_until_done, daemon=True)
+        self.start_bytes = self.peak_bytes = self.memory_in_use()
+
+    def memory_in_use(self):
+        return self.cursor.execute("select sum(memory_usage_bytes) from duckdb_memory()").fetchone()[0] or 0
+
+    def sample_until_done(self):
+        while not self.done.wait(memory_sample_interval):
+            self.peak_bytes = max(self.peak_bytes, self.memory_in_use())
+
+    def __enter__(self):
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.done.set()
+        self.sampler.join()
+        self.peak_bytes = max(self.peak_bytes, self.memory_in_use())
+        self.cursor.close()
+
+    @property
+    def used_bytes(self):
+        return self.peak_bytes - self.start_bytes
+
+
+class LocalWarehouse:
+    """The raw, staging, datawarehouse and datamart layers in a DuckDB database."""
+
+    def __init__(self, database=":memory:", data_dir=default_data_dir, listings_dir=None, profile=False,
+                 file_format=ingest_format, city_listings_dirs=None):
+        self.conn = duckdb.connect(database)
+        self.data_dir = data_dir
+        # Listings folder of every city, <data-dir>/listings_<city> unless given
+        self.listings_dirs = {city: os.path.join(data_dir, city_listings_folder(city)) for city in cities}
+        self.listings_dirs.update(city_listings_dirs or {})
+        self.listings_dirs[default_city] = listings_dir or os.path.join(data_dir, "listings")
+        self.file_format = file_format
+        self.profile_path = None
+        if profile:
+            # DuckDB rewrites this file with the JSON profile of every query it runs
+            self.profile_path = os.path.join(tempfile.mkdtemp(prefix="bde_at3_profile_"), "profile.json")
+            self.conn.execute("pragma enable_profiling = 'json'")
+            self.conn.execute(f"pragma profiling_output = '{self.profile_path}'")
+        for schema in ("raw", "staging", "datawarehouse", "datamart"):
+            for city in {default_city, *cities}:
+                self.conn.execute(f"create schema if not exists {city_schema(schema, city)}")
+        self.conn.execute(dialect_macros)
+        for table in external_tables:
+            for city in cities if table == "listings" else [default_city]:
+                self.refresh_external_table(table, city)
+
+    def external_table_files(self, table, city=default_city):
+        folder, pattern = external_tables[table]
+        if self.file_format == "parquet" and table in parquet_tables:
+            pattern = os.path.splitext(pattern)[0] + ".parquet"
+        if table == "listings":
+            folder, directory = city_listings_folder(city), self.listings_dirs[city]
+        else:
+            directory = os.path.join(self.data_dir, folder)
+        return folder, sorted(glob.glob(os.path.join(directory, pattern)))
+
+    def refresh_external_table(self, table, city=default_city):
+        # Equivalent of `alter external table raw.<table> refresh`: re-list the files and rebuild raw.<table>,
+        # the listings of a city are in the raw schema of the city
+        schema = city_schema("raw", city) if table == "listings" else "raw"
+        folder, files = self.external_table_files(table, city)
+        parquet = self.file_format == "parquet" and table in parquet_tables
+        # The listings columns are known, so an empty raw.listings can be created when there are no files yet
+        column_count = listings_column_count if table == "listings" else 0
+        for path in files if not parquet else []:
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                column_count = max(column_count, len(next(csv.reader(f), [])))
+        columns = [f"c{i}" for i in range(1, column_count + 1)]
+
+        existing = self.conn.execute(
+            "select table_type from information_schema.tables where table_schema = ? and table_name = ?", [schema, table]
+        ).fetchone()
+        if existing:
+            self.conn.execute(f"drop {'view' if existing[0] == 'VIEW' else 'table'} {schema}.{table}")
+
+        if files and parquet:
+            # Typed c1..cN columns, DuckDB only reads the columns that a query projects
+            self.conn.execute(f"""
+                create view {schema}.{table} as
+                select * exclude (filename)
+                    , 'data/{folder}/' || parse_filename(filename) as metadata_filename
+                    , split_part(parse_filename(filename), '.', 1) as file_month_year
+                from read_parquet({sql_list(files)}, filename = true, union_by_name = true)
+            """)
+        elif files:
+            # One read_csv per file: a read_csv over several files detects the line endings of the first file
+            # only, and reads no rows from a file whose line endings differ
+            column_types = ", ".join(f"'{column}': 'VARCHAR'" for column in columns)
+            file_selects = "\n                union all\n".join(f"""
+                select {", ".join(columns)}
+                    , 'data/{folder}/' || parse_filename(filename) as metadata_filename
+                    , split_part(parse_filename(filename), '.', 1) as file_month_year
+                from read_csv({sql_list([path])}, header = false, skip = 1, columns = {{{column_types}}},
+                              nullstr = {sql_list(csv_null_values)}, quote = '"', null_padding = true, filename = true)"""
+                for path in files)
+            self.conn.execute(f"create view {schema}.{table} as {file_selects}")
+        else:
+            self.conn.execute(f"""
+                create table {schema}.{table} as
+                select {", ".join(f"null::varchar as {column}" for column in columns)}
+                    , null::varchar as metadata_filename, null::varchar as file_month_year
+                limit 0
+            """)
+
+        self.conn.execute(f"""
+            create or replace table {schema}.{table}_files (
+                file_name varchar, file_size bigint, md5 varchar, last_modified timestamptz
+            )
+        """)
+        data_lines = {}
+        for path in files:
+            md5 = hashlib.md5()
+            lines, last_block = 0, b""
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    md5.update(block)
+                    lines += block.count(b"\n")
+                    last_block = block
+            # Lines after the header, counting a last line without a line break
+            data_lines[f"data/{folder}/{os.path.basename(path)}"] = lines - 1 + (not last_block.endswith(b"\n"))
+            stat = os.stat(path)
+            self.conn.execute(f"insert into {schema}.{table}_files values (?, ?, ?, ?)", [
+                f"data/{folder}/{os.path.basename(path)}",
+                stat.st_size,
+                md5.hexdigest(),
+                datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+            ])
+        if files and not parquet:
+            self.check_file_rows(schema, table, data_lines)
+
+    def check_file_rows(self, schema, table, data_lines):
+        # A file that reads no rows, or more rows than it has lines, was not parsed the way it was written.
+        # Quoted line breaks make a file read fewer rows than lines, so only those two cases are errors
+        rows = dict(self.conn.execute(
+            f"select metadata_filename, count(*) from {schema}.{table} group by metadata_filename"
+        ).fetchall())
+        for file_name, lines in data_lines.items():
+            file_rows = rows.get(file_name, 0)
+            if (lines > 0 and file_rows == 0) or file_rows > lines:
+                raise ValueError(f"{schema}.{table}: {file_name} read {file_rows} rows from {lines} data lines")
+
+    def run_task(self, task_id, sql):
+        metrics = []
+        for statement_number, statement in enumerate(split_statements(sql), 1):
+            code = "\n".join(line for line in statement.splitlines() if not line.strip().startswith("--")).strip()
+            started = time.perf_counter()
+            refresh = refresh_external_table.match(code)
+            executed = not refresh and not snowflake_only_statement.match(code)
+            if refresh:
+                schema, table = refresh.group(1, 2) if refresh.group(2) else refresh.group(3, 4)
+                self.refresh_external_table(table, schema_city(schema))
+            elif executed and self.profile_path:
+                with StatementMemory(self.conn) as memory:
+                    for duckdb_statement in split_alter_columns(to_duckdb(code)):
+                        self.conn.execute(duckdb_statement)
+            elif executed:
+                for duckdb_statement in split_alter_columns(to_duckdb(code)):
+                    self.conn.execute(duckdb_statement)
+            statement_metrics = {
+                "task_id": task_id,
+                "statement_number": statement_number,
+                "statement": code.splitlines()[0],
+                "elapsed_seconds": time.perf_counter() - started,
+            }
+            if self.profile_path and executed:
+                with open(self.profile_path) as f:
+                    profile = json.load(f)
+                statement_metrics["rows_scanned"] = profile.get("cumulative_rows_scanned", 0)
+                # Measured per statement, the buffer manager high-water mark of the profile covers every earlier task
+                statement_metrics["peak_memory_bytes"] = memory.used_bytes
+            metrics.append(statement_metrics)
+        return metrics
+
+    def stage_files_changed(self, table, city=default_city):
+        self.run_task(f"check_{city_table(table, city)}_files_task", stage_fingerprint_sql(table, city))
+        return self.conn.execute(to_duckdb(changed_stage_files_sql(table, city))).fetchone()[0] > 0
+
+    def run_dag(self, tasks=table_tasks, skip_unchanged=False):
+        # Runs the tasks in spec order. With skip_unchanged, a staging table whose files are unchanged is skipped
+        # and so is every table whose upstream tables were all skipped, like the short-circuits of the DAG
+        metrics = []
+        skipped = set()
+        for table, (sql, upstream_tables) in tasks.items():
+            task_id = table_task_id(table)
+            if skip_unchanged and (
+                (table in staging_sources and not self.stage_files_changed(*staging_sources[table]))
+                or (upstream_tables and skipped.issuperset(upstream_tables))
+            ):
+                logging.info("%s: skipped, its inputs are unchanged", task_id)
+                skipped.add(table)
+                continue
+            task_metrics = self.run_task(task_id, sql)
+            logging.info("%s: %d statements in %.3fs", task_id, len(task_metrics),
+                         sum(m["elapsed_seconds"] for m in task_metrics))
+            metrics.extend(task_metrics)
+        return metrics
+
+
+#########################################################
+#
+#   Datamart Outputs
+#
+#########################################################
+
+def export_datamarts(warehouse, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    for table, keys in datamart_snapshots.items():
+        path = os.path.join(output_dir, f"{table}.csv")
+        warehouse.conn.execute(f"copy (select * from datamart.{table} order by {', '.join(keys)}) to '{path}' (header)")
+
+
+def stream_datamarts(warehouse, output_dir, export_format, city=default_city):
+    # Same streaming export and content-hash cache as the export_datamarts_task of the DAG
+    def content_hash(table):
+        sql = city_sql(query_datamart_content_hash.format(table=table), city)
+        return warehouse.conn.execute(to_duckdb(sql)).fetchone()
+
+    def record_batches(table):
+        sql = city_sql(query_datamart_export.format(table=table, keys=", ".join(datamart_tables[table])), city)
+        return warehouse.conn.execute(sql).to_arrow_reader(batch_rows)
+
+    return export_datamart_tables(content_hash, record_batches, city_export_dir(output_dir, city), export_format)
+
+
+def compare_with_snapshots(warehouse, snapshot_dir=repo_dir, tolerance=1e-4):
+    # Returns {table: {column: number of rows that differ}} against the committed dm_*.csv files
+    differences = {}
+    for table, keys in datamart_snapshots.items():
+        path = os.path.join(snapshot_dir, f"{table}.csv")
+        conn = warehouse.conn
+        conn.execute(f"create or replace temporary table snapshot_{table} as select * from read_csv(?, header = true)", [path])
+        columns = [row[0].lower() for row in conn.execute(f"describe snapshot_{table}").fetchall()]
+        join = " and ".join(f"local.{key} is not distinct from snapshot.{key}" for key in keys)
+        table_differences = {
+            "missing_rows": conn.execute(f"""
+                select count(*) from snapshot_{table} snapshot
+                where not exists (select 1 from datamart.{table} local where {join})
+            """).fetchone()[0],
+            "extra_rows": conn.execute(f"""
+                select count(*) from datamart.{table} local
+                where not exists (select 1 from snapshot_{table} snapshot where {join})
+            """).fetchone()[0],
+        }
+        for column in columns:
+            if column in keys:
+                continue
+            table_differences[column] = conn.execute(f"""
+                select count(*) from datamart.{table} local
+                inner join snapshot_{table} snapshot on {join}
+                where not (
+                    (local.{column} is null and snapshot.{column} is null)
+                    or abs(local.{column} - snapshot.{column}) <= {tolerance} * greatest(1, abs(snapshot.{column}))
+                )
+            """).fetchone()[0]
+        differences[table] = table_differences
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bde_at_3 transformations locally on DuckDB")
+    parser.add_argument("--database", default=":memory:", help="DuckDB database file, in memory by default")
+    parser.add_argument("--data-dir", default=default_data_dir, help="directory with the NSW_LGA and Census_LGA folders")
+    parser.add_argument("--listings-dir", help="directory with the MM_YYYY.csv listings files, <data-dir>/listings by default")
+    parser.add_argument("--city-listings-dir", action="append", default=[], metavar="CITY=DIR",
+                        help="listings directory of one of the BDE_CITIES, <data-dir>/listings_<city> by default")
+    parser.add_argument("--file-format", choices=["csv", "parquet"], default=ingest_format,
+                        help="read the listings and census files as csv or as the Parquet files of bde_at3_parquet.py")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="skip the tables whose input files are unchanged since their last load")
+    parser.add_argument("--export-dir", help="write the datamart tables to this directory as csv files")
+    parser.add_argument("--stream-dir", help="stream the changed datamart tables to this directory as compressed files")
+    parser.add_argument("--stream-format", choices=["csv", "parquet"], default="csv",
+                        help="write the streamed datamart tables as gzip csv or zstd Parquet files")
+    parser.add_argument("--compare", action="store_true", help="compare the datamart tables with the committed dm_*.csv files")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    city_listings_dirs = dict(value.split("=", 1) for value in args.city_listings_dir)
+    warehouse = LocalWarehouse(args.database, args.data_dir, args.listings_dir, file_format=args.file_format,
+                               city_listings_dirs=city_listings_dirs)
+    metrics = warehouse.run_dag(skip_unchanged=args.skip_unchanged)
+    logging.info("Ran %d statements in %.3fs", len(metrics), sum(m["elapsed_seconds"] for m in metrics))
+    for city in cities:
+        for name_kind, name, row_count in warehouse.conn.execute(city_sql(query_unmatched_names, city)).fetchall():
+            logging.warning("%s: unmatched %s %r in %d rows", city, name_kind, name, row_count)
+        violations = warehouse.conn.execute(to_duckdb(city_sql(query_referential_integrity, city))).fetchone()
+        for check, count in zip(referential_integrity_checks, violations):
+            if count:
+                logging.warning("%s: %s: %d rows violate the constraint", city, check, count)
+
+    # The committed snapshots are the datamart tables of the default city
+    if args.export_dir:
+        export_datamarts(warehouse, args.export_dir)
+    if args.stream_dir:
+        for city in cities:
+            stream_datamarts(warehouse, args.stream_dir, args.stream_format, city)
+    if args.compare:
+        mismatched = False
+        for table, table_differences in compare_with_snapshots(warehouse).items():
+            for column, count in table_differences.items():
+                if count:
+                    mismatched = True
+                    logging.warning("%s.%s: %d rows differ from the committed snapshot", table, column, count)
+        if mismatched:
+            raise SystemExit(1)
+        logging.info("Datamart tables match the committed snapshots")
+
+
+if __name__ == "__main__":
+    main()
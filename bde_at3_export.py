@@ -0,0 +1,134 @@
+import os
+import json
+import logging
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from bde_at3_sql import datamart_tables, default_city
+
+
+#########################################################
+#
+#   Export Settings
+#
+#########################################################
+
+# Rows fetched per Arrow batch, only one batch is held in memory while a table is exported
+batch_rows = 100000
+
+export_compression = {
+    "csv": "gzip",
+    "parquet": "zstd",
+}
+
+export_extensions = {
+    "csv": ".csv.gz",
+    "parquet": ".parquet",
+}
+
+# Content hash, row count and file of the last export of every datamart table
+cache_file_name = "export_cache.json"
+
+
+#########################################################
+#
+#   Export Cache
+#
+#########################################################
+
+def read_export_cache(output_dir):
+    path = os.path.join(output_dir, cache_file_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_export_cache(output_dir, cache):
+    path = os.path.join(output_dir, cache_file_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def is_cached(cache, table, content_hash, export_format, output_dir):
+    cached = cache.get(table)
+    return bool(
+        cached
+        and cached["content_hash"] == content_hash
+        and cached["format"] == export_format
+        and os.path.exists(os.path.join(output_dir, cached["file_name"]))
+    )
+
+
+#########################################################
+#
+#   Streaming Writers
+#
+#########################################################
+
+def write_batches(batches, path, export_format):
+    # Writes an iterator of Arrow record batches or tables to one compressed file and returns the number of rows.
+    # The file is written next to its final path and moved into place, so a failed export keeps the previous file.
+    # An empty result is written from the schema of an empty table or of a RecordBatchReader, so the file
+    # still has its csv header or its Parquet footer.
+    rows = 0
+    writer = None
+    temporary_path = path + ".tmp"
+    sink = pa.CompressedOutputStream(temporary_path, export_compression["csv"]) if export_format == "csv" else None
+
+    def open_writer(schema):
+        if export_format == "csv":
+            return pv.CSVWriter(sink, schema)
+        return pq.ParquetWriter(temporary_path, schema, compression=export_compression["parquet"])
+
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = open_writer(batch.schema)
+            writer.write(batch)
+            rows += batch.num_rows
+        if writer is None:
+            schema = getattr(batches, "schema", None)
+            if schema is None:
+                raise ValueError(f"{path}: no batches and no schema to write an empty file from")
+            writer = open_writer(schema)
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    os.replace(temporary_path, path)
+    return rows
+
+
+def city_export_dir(output_dir, city):
+    # The default city exports to output_dir, the other cities to a folder per city under it
+    return output_dir if city == default_city else os.path.join(output_dir, city)
+
+
+def export_datamart_tables(content_hash, record_batches, output_dir, export_format="csv", tables=datamart_tables):
+    # Streams every datamart table whose content changed since its last export into output_dir.
+    # content_hash(table) returns (hash, row count) computed in the warehouse and record_batches(table)
+    # returns an iterator of Arrow batches of the table, so only the changed tables are fetched.
+    os.makedirs(output_dir, exist_ok=True)
+    cache = read_export_cache(output_dir)
+    exported = {}
+    for table in tables:
+        table_hash, row_count = content_hash(table)
+        table_hash = str(table_hash)
+        if is_cached(cache, table, table_hash, export_format, output_dir):
+            logging.info("datamart.%s: unchanged since its last export, %s", table, cache[table]["file_name"])
+            continue
+        file_name = table + export_extensions[export_format]
+        rows = write_batches(record_batches(table), os.path.join(output_dir, file_name), export_format)
+        if rows != row_count:
+            raise ValueError(f"datamart.{table}: exported {rows} rows, the table has {row_count}")
+        cache[table] = {"content_hash": table_hash, "rows": rows, "format": export_format, "file_name": file_name}
+        # Saved after every table, so a failed run does not export the tables it finished again
+        write_export_cache(output_dir, cache)
+        exported[table] = rows
+        logging.info("datamart.%s: exported %d rows to %s", table, rows, file_name)
+    return exported
@@ -0,0 +1,138 @@
+import os
+import re
+import csv
+import glob
+import argparse
+import logging
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from bde_at3_census import census_dir, census_packs, census_file_columns
+from bde_at3_sql import listings_columns, csv_null_values
+
+
+#########################################################
+#
+#   Parquet Settings
+#
+#########################################################
+
+# Bytes of csv parsed per chunk, only one chunk is held in memory while a file is converted
+chunk_bytes = 16 << 20
+
+# Snowflake reads snappy compressed Parquet with compression = 'AUTO'
+parquet_compression = "snappy"
+
+arrow_types = {
+    "int": pa.int64(),
+    "bigint": pa.int64(),
+    "float": pa.float64(),
+    "boolean": pa.bool_(),
+    "date": pa.date32(),
+    "varchar": pa.string(),
+}
+
+
+#########################################################
+#
+#   Typed Schemas
+#
+#########################################################
+
+# Parquet columns keep the c1..cN names of the csv external tables, so that `value:cN` in the staging SQL
+# reads the same column from either format and Snowflake only scans the columns that the SQL projects
+def listings_column_types():
+    # Columns that staging casts directly are stored with that type, the others (e.g. host_since) stay text
+    column_types = {}
+    for name, column_type, expression in listings_columns:
+        match = re.fullmatch(r"value:(c\d+)", expression)
+        if match:
+            column_types[match.group(1)] = arrow_types[column_type]
+    return column_types
+
+
+def census_column_types(file_name):
+    return {f"c{position}": arrow_types[column_type]
+            for position, (name, column_type) in enumerate(census_file_columns(file_name), 1)}
+
+
+#########################################################
+#
+#   Conversion
+#
+#########################################################
+
+def convert_csv(csv_path, parquet_path, column_types):
+    # Streams one csv file into a Parquet file chunk by chunk and returns the number of rows written
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        column_count = len(next(csv.reader(f), []))
+    column_names = [f"c{i}" for i in range(1, column_count + 1)]
+    reader = pv.open_csv(
+        csv_path,
+        read_options=pv.ReadOptions(column_names=column_names, skip_rows=1, block_size=chunk_bytes),
+        convert_options=pv.ConvertOptions(
+            column_types={name: column_types.get(name, pa.string()) for name in column_names},
+            null_values=csv_null_values,
+            strings_can_be_null=True,
+            true_values=["t", "true", "TRUE"],
+            false_values=["f", "false", "FALSE"],
+        ),
+    )
+    rows = 0
+    os.makedirs(os.path.dirname(parquet_path) or ".", exist_ok=True)
+    temporary_path = parquet_path + ".tmp"
+    with pq.ParquetWriter(temporary_path, reader.schema, compression=parquet_compression) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    os.replace(temporary_path, parquet_path)
+    return rows
+
+
+def parquet_path_for(csv_path, output_dir=None):
+    file_name = os.path.splitext(os.path.basename(csv_path))[0] + ".parquet"
+    return os.path.join(output_dir or os.path.dirname(csv_path), file_name)
+
+
+def convert_listings(listings_dir, output_dir=None):
+    column_types = listings_column_types()
+    converted = {}
+    for csv_path in sorted(glob.glob(os.path.join(listings_dir, "*.csv"))):
+        parquet_path = parquet_path_for(csv_path, output_dir)
+        # Skip the months whose Parquet file is newer than the csv
+        if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+            continue
+        converted[parquet_path] = convert_csv(csv_path, parquet_path, column_types)
+        logging.info("Converted %s to %s: %d rows", csv_path, parquet_path, converted[parquet_path])
+    return converted
+
+
+def convert_census(output_dir=None):
+    converted = {}
+    for table, pack in census_packs.items():
+        csv_path = os.path.join(census_dir, pack["file_name"])
+        parquet_path = parquet_path_for(csv_path, output_dir)
+        converted[parquet_path] = convert_csv(csv_path, parquet_path, census_column_types(pack["file_name"]))
+        logging.info("Converted %s to %s: %d rows", csv_path, parquet_path, converted[parquet_path])
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the listings and census csv files to typed Parquet before upload")
+    parser.add_argument("--listings-dir", help="directory with the MM_YYYY.csv listings files")
+    parser.add_argument("--listings-output-dir", help="directory for the listings Parquet files, the listings directory by default")
+    parser.add_argument("--census-output-dir", help="directory for the census Parquet files, the census directory by default")
+    parser.add_argument("--skip-census", action="store_true", help="only convert the listings files")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.listings_dir:
+        convert_listings(args.listings_dir, args.listings_output_dir)
+    if not args.skip_census:
+        convert_census(args.census_output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1210 @@
+import os
+import re
+
+from bde_at3_census import census_packs, census_staging_columns, dim_lga_census_columns
+
+
+#########################################################
+#
+#   Load Environment Variables
+#
+#########################################################
+# Set BDE_LISTINGS_FULL_REFRESH=true to reload every listings file instead of only the new or changed ones
+listings_full_refresh = os.environ.get("BDE_LISTINGS_FULL_REFRESH", "false").lower() == "true"
+
+# Set BDE_INGEST_FORMAT=parquet when the listings and census files are uploaded as Parquet by bde_at3_parquet.py
+ingest_format = os.environ.get("BDE_INGEST_FORMAT", "csv").lower()
+ingest_file_format = {"csv": "file_format_csv", "parquet": "file_format_parquet"}[ingest_format]
+
+# Listings feeds loaded by the DAG, e.g. BDE_CITIES=sydney,melbourne,brisbane. Every city has its own listings
+# folder, stage and external table, and its own raw, staging, datawarehouse and datamart schemas suffixed with
+# the city name. The default city keeps the unsuffixed schemas and the task ids of the single city pipeline
+default_city = "sydney"
+cities = [city.strip().lower() for city in os.environ.get("BDE_CITIES", default_city).split(",") if city.strip()]
+
+
+#########################################################
+#
+#   Transformation SQL
+#
+#   Kept free of Airflow imports so that the same SQL can run on
+#   Snowflake through the DAG or locally through bde_at3_duckdb.py
+#
+#########################################################
+
+# Snowflake does not enforce primary and foreign keys, they are declared once in the table DDL with RELY
+# so that the optimizer can use them, e.g. to drop a join to a dimension none of whose columns are selected.
+# The fact rows of every load are checked against them by query_referential_integrity instead
+constraint_properties = "not enforced rely"
+
+# Foreign keys of the fact table: constraint name, column, dimension table with a primary key on the same column
+fact_listings_foreign_keys = [
+    ("fact_listings_fk_dim_listings", "auto_gen_listing_id", "datawarehouse.dim_listings"),
+    ("fact_listings_fk_dim_host", "auto_gen_host_id", "datawarehouse.dim_host"),
+    ("fact_listings_fk_dim_lga", "lga_code", "datawarehouse.dim_lga"),
+    ("fact_listings_fk_dim_suburb", "suburb_id", "datawarehouse.dim_suburb"),
+    ("fact_listings_fk_dim_date", "date_id", "datawarehouse.dim_date"),
+]
+
+
+def city_schema(schema, city):
+    return schema if city == default_city else f"{schema}_{city}"
+
+
+def city_table(table, city):
+    # Name of a per city table in the task spec, also used in the DAG task ids
+    return table if city == default_city else f"{table}_{city}"
+
+
+def city_listings_folder(city):
+    # Folder of the city's listings files in the data directory of the bucket and under the local data directory
+    return city_table("listings", city)
+
+
+# Objects of the city schemas, every datamart object is per city. The other raw, staging and datawarehouse
+# objects, the lga and suburb lookups and the conformed dim_lga, dim_suburb and dim_date, are shared by the cities
+city_objects = {
+    "raw": {"listings"},
+    "staging": {
+        "listings", "listings_delta", "listings_pending_months", "listings_file_manifest", "stage_file_manifest",
+        "neighbourhood_name_index", "unmatched_names", "loaded_hosts",
+    },
+    "datawarehouse": {
+        "dim_listings", "dim_host", "fact_listings", "fact_listings_wide", "kpi_lga_month", "kpi_property_type_month",
+    },
+}
+
+
+def city_sql(sql, city):
+    # Points the per city objects of the SQL of the single city pipeline at the schemas of a city
+    if city == default_city:
+        return sql
+    return re.sub(
+        r"\b(raw|staging|datawarehouse|datamart)\.(\w+)",
+        lambda m: f"{m.group(1)}_{city}.{m.group(2)}"
+        if m.group(1) == "datamart" or m.group(2) in city_objects[m.group(1)] else m.group(0),
+        sql,
+    )
+
+
+def file_month_year(file_name):
+    # MM_YYYY month of a listings file from the name of the file, whatever the folder of its city
+    return f"split_part(split_part({file_name}, '/', -1), '.', 0)"
+
+
+def name_key(expression):
+    # Casefolded name with every run of whitespace and punctuation collapsed to a single space
+    return f"trim(regexp_replace(lower({expression}), '[^a-z0-9]+', ' '))"
+
+
+# Staging tables are described as (column name, type, expression) so that every derived column
+# is computed on the first read of the external table
+nsw_lga_code_columns = [
+    ("lga_code", "int", "value:c1"),
+    ("lga_name", "varchar", "value:c2"),
+    ("lga_name_key", "varchar", name_key("value:c2::varchar")),
+]
+
+nsw_lga_suburb_columns = [
+    ("lga_name", "varchar", "value:c1"),
+    ("suburb_name", "varchar", "value:c2"),
+    ("lga_name_key", "varchar", name_key("value:c1::varchar")),
+    ("suburb_name_key", "varchar", name_key("value:c2::varchar")),
+]
+
+listings_columns = [
+    ("listing_id", "int", "value:c1"),
+    ("scrape_id", "bigint", "value:c2"),
+    ("scrape_date", "date", "value:c3"),
+    ("host_id", "int", "value:c4"),
+    ("host_name", "varchar", "value:c5"),
+    ("host_is_superhost", "boolean", "value:c7"),
+    ("host_neighbourhood", "varchar", "value:c8"),
+    ("listing_neighbourhood", "varchar", "value:c9"),
+    ("property_type", "varchar", "value:c10"),
+    ("room_type", "varchar", "value:c11"),
+    ("accomodates", "int", "value:c12"),
+    ("price", "int", "value:c13"),
+    ("has_availability", "boolean", "value:c14"),
+    ("availability_30", "int", "value:c15"),
+    ("number_reviews", "int", "value:c16"),
+    ("review_scores_ratings", "int", "value:c17"),
+    ("review_scores_accuracy", "int", "value:c18"),
+    ("review_scores_cleanliness", "int", "value:c19"),
+    ("review_scores_checkin", "int", "value:c20"),
+    ("review_scores_communication", "int", "value:c21"),
+    ("review_scores_value", "int", "value:c22"),
+    ("host_since", "date", "to_date(value:c6::varchar, 'DD/MM/YYYY')"),
+    ("month_year", "date", "to_date('01' || '_' || file_month_year, 'DD_MM_YYYY')"),
+]
+
+# Number of columns of a listings file, the last value:cN column that the staging projection reads
+listings_column_count = max(int(position) for name, column_type, expression in listings_columns
+                            for position in re.findall(r"value:c(\d+)", expression))
+
+# Same null markers as file_format_csv in part_1.sql, for the readers of the csv files outside Snowflake
+csv_null_values = ["\\N", "NULL", "NUL", ""]
+
+
+def python_date_format(date_format):
+    # strptime format of a Snowflake date format such as 'DD/MM/YYYY'
+    return date_format.replace("YYYY", "%Y").replace("MM", "%m").replace("DD", "%d")
+
+
+def select_projection(columns):
+    return "\n".join(
+        f"    {'' if i == 0 else ', '}{expression}::{column_type} as {name}"
+        for i, (name, column_type, expression) in enumerate(columns)
+    )
+
+
+def column_definitions(columns):
+    return "\n".join(
+        f"    {'' if i == 0 else ', '}{name} {column_type}"
+        for i, (name, column_type, expression) in enumerate(columns)
+    )
+
+
+def census_staging_sql(table):
+    # External table refresh and single-pass staging table of a census pack, pruned to the used columns
+    pack = census_packs[table]
+    return f"""
+-- Create the external table on the first run so that a new census pack only needs an entry in census_packs
+create external table if not exists raw.{table}
+with location = @stage_gcp_census_lga
+file_format = {ingest_file_format}
+pattern = '.*{os.path.splitext(pack["file_name"])[0]}[.]{ingest_format}';
+
+alter external table raw.{table} refresh;
+
+-- Transferring the used columns of raw.{table} to staging as a table with the clean lga code in a single pass
+create or replace table staging.{table} as
+select
+{select_projection(census_staging_columns(table))}
+from raw.{table};
+"""
+
+
+def dim_lga_sql():
+    census_columns = dim_lga_census_columns()
+    names = ["lga_code", "lga_name"] + [name for table, name, column_type in census_columns]
+    return f"""
+-- Create the lga dimension table on the first run
+create table if not exists datawarehouse.dim_lga (
+    lga_code int primary key {constraint_properties}
+    , lga_name varchar
+{chr(10).join(f"    , {name} {column_type}" for table, name, column_type in census_columns)}
+);
+
+-- Add the columns of new census packs or newly used census columns to an existing lga dimension table
+alter table datawarehouse.dim_lga add column if not exists
+{chr(10).join(f"    {'' if i == 0 else ', '}{name} {column_type}" for i, (table, name, column_type) in enumerate(census_columns))};
+
+-- Upsert the lga dimension table on the natural lga_code key
+merge into datawarehouse.dim_lga
+using (
+    select
+    staging.nsw_lga_code.lga_code,
+    staging.nsw_lga_code.lga_name,
+{(","+chr(10)).join(f"    staging.{table}.{name}" for table, name, column_type in census_columns)}
+    from staging.nsw_lga_code
+{chr(10).join(f"    left join staging.{table} on staging.nsw_lga_code.lga_code = staging.{table}.clean_lga_code" for table in census_packs)}
+) loaded_lga
+on datawarehouse.dim_lga.lga_code = loaded_lga.lga_code
+when matched then update set
+{(","+chr(10)).join(f"{name} = loaded_lga.{name}" for name in names[1:])}
+when not matched then insert ({", ".join(names)})
+values ({", ".join(f"loaded_lga.{name}" for name in names)});
+"""
+
+
+stage_file_manifest_ddl = """
+-- Keep the name, size and md5 of the files behind every external table as of its last successful load
+create table if not exists staging.stage_file_manifest (
+    table_name varchar
+    , file_name varchar
+    , file_size number
+    , md5 varchar
+    , last_modified timestamp_ltz
+    , loaded_at timestamp_ltz
+);
+"""
+
+
+listings_pending_months_ddl = """
+-- Keep the months staged into staging.listings until every table built from them is loaded, so that the months
+-- of a run that failed after staging are loaded again by the next run
+create table if not exists staging.listings_pending_months (
+    month_year date
+);
+"""
+
+# Months of staging.listings that the dimension, fact, KPI and datamart tasks load
+loaded_months = "(select month_year from staging.listings_pending_months)"
+
+
+def stage_fingerprint_sql(table, city=default_city):
+    # Refresh the file listing of raw.<table> so that its files can be compared with the stage manifest
+    pending_ddl = listings_pending_months_ddl if table == "listings" else ""
+    return city_sql(f"""
+alter external table raw.{table} refresh;
+{stage_file_manifest_ddl}{pending_ddl}""", city)
+
+
+def changed_stage_files_sql(table, city=default_city):
+    # Number of files of raw.<table> that were added, changed or removed since its last successful load.
+    # The listings months still pending from an earlier run count as well, so that their tables are loaded again
+    pending = f"""
+    union all
+    select month_year::varchar, null, null
+    from staging.listings_pending_months""" if table == "listings" else ""
+    return city_sql(f"""
+select count(*) as changed_files
+from (
+    (
+        select file_name, file_size, md5
+        from table(information_schema.external_table_files(table_name => 'raw.{table}'))
+        except
+        select file_name, file_size, md5
+        from staging.stage_file_manifest
+        where table_name = '{table}'
+    )
+    union all
+    (
+        select file_name, file_size, md5
+        from staging.stage_file_manifest
+        where table_name = '{table}'
+        except
+        select file_name, file_size, md5
+        from table(information_schema.external_table_files(table_name => 'raw.{table}'))
+    ){pending}
+) changed_files
+""", city)
+
+
+def record_stage_files_sql(table):
+    return f"""
+{stage_file_manifest_ddl}
+-- Record the files of raw.{table} as loaded, so that the next run skips this table while they are unchanged
+delete from staging.stage_file_manifest
+where table_name = '{table}';
+
+insert into staging.stage_file_manifest
+select '{table}', file_name, file_size, md5, last_modified, current_timestamp()
+from table(information_schema.external_table_files(table_name => 'raw.{table}'));
+"""
+
+
+listings_manifest_reset = """
+-- Forget the loaded files so that every listings file is reloaded
+truncate table staging.listings_file_manifest;
+""" if listings_full_refresh else ""
+
+query_refresh_staging_nsw_lga_suburb = f"""
+alter external table raw.nsw_lga_suburb refresh;
+
+-- Transferring the data from raw.nsw_lga_suburb to staging as a table
+create or replace table staging.nsw_lga_suburb as
+select
+{select_projection(nsw_lga_suburb_columns)}
+from raw.nsw_lga_suburb;
+"""
+
+query_refresh_dim_suburb = f"""
+-- Create an intermediate table to get the mapping of the lga code to the suburb
+create or replace table staging.lga_code_suburb as
+select staging.lga_name_index.lga_code, staging.lga_name_index.lga_name, staging.nsw_lga_suburb.suburb_name, staging.nsw_lga_suburb.lga_name as suburb_lga_name
+from staging.nsw_lga_suburb
+left join staging.lga_name_index on staging.nsw_lga_suburb.lga_name_key = staging.lga_name_index.name_key;
+
+-- Create the suburb dimension table with suburb_id, lga_code and suburb_name on the first run
+create table if not exists datawarehouse.dim_suburb (
+    suburb_id int primary key {constraint_properties}
+    , lga_code int
+    , suburb_name varchar
+);
+
+-- Append only the new suburbs so that the existing suburb_ids stay stable
+merge into datawarehouse.dim_suburb
+using (
+    select
+    (select coalesce(max(suburb_id), 0) from datawarehouse.dim_suburb) + row_number() over (order by member_count desc) as suburb_id,
+    lga_code, suburb_name
+    from (
+        select lga_code, suburb_name, count(*) as member_count
+        from staging.lga_code_suburb
+        group by lga_code, suburb_name
+    ) loaded_suburbs
+    where not exists (
+        select 1 from datawarehouse.dim_suburb
+        where datawarehouse.dim_suburb.lga_code is not distinct from loaded_suburbs.lga_code
+        and datawarehouse.dim_suburb.suburb_name is not distinct from loaded_suburbs.suburb_name
+    )
+) new_suburbs
+on datawarehouse.dim_suburb.lga_code is not distinct from new_suburbs.lga_code
+and datawarehouse.dim_suburb.suburb_name is not distinct from new_suburbs.suburb_name
+when not matched then insert (suburb_id, lga_code, suburb_name)
+values (new_suburbs.suburb_id, new_suburbs.lga_code, new_suburbs.suburb_name);
+
+-- Index the suburbs of the current mapping on their normalized name key, keeping the first suburb_id of a name.
+-- Suburbs that are no longer in the mapping stay in the dimension for the older fact rows, but new rows do not resolve to them
+create or replace table staging.suburb_name_index as
+select {name_key("datawarehouse.dim_suburb.suburb_name")} as name_key, min(datawarehouse.dim_suburb.suburb_id) as suburb_id
+from datawarehouse.dim_suburb
+inner join (
+    select distinct lga_code, suburb_name
+    from staging.lga_code_suburb
+) current_suburbs
+on datawarehouse.dim_suburb.lga_code is not distinct from current_suburbs.lga_code
+and datawarehouse.dim_suburb.suburb_name is not distinct from current_suburbs.suburb_name
+group by name_key;
+"""
+
+query_refresh_staging_nsw_lga_code = f"""
+alter external table raw.nsw_lga_code refresh;
+
+-- Transferring the data from raw.nsw_lga_code to staging as a table
+create or replace table staging.nsw_lga_code as
+select
+{select_projection(nsw_lga_code_columns)}
+from raw.nsw_lga_code;
+
+-- Index the lga names on their normalized name key
+create or replace table staging.lga_name_index as
+select lga_name_key as name_key, min(lga_code) as lga_code, min(lga_name) as lga_name
+from staging.nsw_lga_code
+group by lga_name_key;
+"""
+
+query_refresh_dim_lga = dim_lga_sql()
+
+staging_listings_ddl = f"""
+-- Create the staging listings table partitioned by month on the first run
+create table if not exists staging.listings (
+{column_definitions(listings_columns)}
+)
+cluster by (month_year);
+"""
+
+query_refresh_staging_listings = f"""
+alter external table raw.listings refresh;
+
+-- Keep a manifest of the listings files that have already been loaded into staging
+create table if not exists staging.listings_file_manifest (
+    file_name varchar
+    , month_year date
+    , file_size number
+    , md5 varchar
+    , last_modified timestamp_ltz
+    , loaded_at timestamp_ltz
+);
+{listings_manifest_reset}
+-- Find the listings files that are new, have changed or have been removed since the last load
+create or replace transient table staging.listings_delta as
+with stage_files as (
+    select file_name, file_size, md5, last_modified
+    from table(information_schema.external_table_files(table_name => 'raw.listings'))
+)
+select
+    coalesce(stage_files.file_name, staging.listings_file_manifest.file_name) as file_name
+    , to_date('01' || '_' || {file_month_year("coalesce(stage_files.file_name, staging.listings_file_manifest.file_name)")}, 'DD_MM_YYYY') as month_year
+    , stage_files.file_size
+    , stage_files.md5
+    , stage_files.last_modified
+from stage_files
+full outer join staging.listings_file_manifest on stage_files.file_name = staging.listings_file_manifest.file_name
+where staging.listings_file_manifest.file_name is null
+or stage_files.file_name is null
+or stage_files.file_size <> staging.listings_file_manifest.file_size
+or stage_files.md5 is distinct from staging.listings_file_manifest.md5
+or stage_files.last_modified <> staging.listings_file_manifest.last_modified;
+{staging_listings_ddl}
+-- Remove the months that are about to be reloaded or whose file has been removed
+delete from staging.listings
+where month_year in (select month_year from staging.listings_delta);
+
+-- Parse only the new or changed files from raw.listings in a single pass
+insert into staging.listings
+select
+{select_projection(listings_columns)}
+from raw.listings
+where file_month_year in (select {file_month_year("file_name")} from staging.listings_delta)
+and metadata$filename in (select file_name from staging.listings_delta);
+
+-- Record the loaded files in the manifest
+delete from staging.listings_file_manifest
+where file_name in (select file_name from staging.listings_delta);
+
+insert into staging.listings_file_manifest
+select file_name, month_year, file_size, md5, last_modified, current_timestamp()
+from staging.listings_delta
+where file_size is not null;
+{listings_pending_months_ddl}
+-- Queue the reloaded and removed months for the downstream tables
+insert into staging.listings_pending_months
+select distinct month_year
+from staging.listings_delta
+where month_year not in (select month_year from staging.listings_pending_months);
+
+-- The queued months carry the delta to the downstream tasks, empty it so that no later run reads a stale delta
+delete from staging.listings_delta;
+"""
+
+# A changed lga, suburb or census file changes the fact rows of every month, so the dimension tasks built from them
+# queue every staged month of every city, and the fact, KPI and datamart tasks that they trigger reload the full history
+query_requeue_listings_months = "".join(city_sql(f"""{staging_listings_ddl}{listings_pending_months_ddl}
+insert into staging.listings_pending_months
+select distinct month_year
+from staging.listings
+where month_year not in (select month_year from staging.listings_pending_months);
+""", city) for city in cities)
+
+query_refresh_dim_listings = f"""
+-- Create the listings dimension table on the first run
+create table if not exists datawarehouse.dim_listings (
+    auto_gen_listing_id int primary key {constraint_properties}
+    , original_listing_id int
+    , property_type varchar
+    , room_type varchar
+    , accomodates int
+    , has_availability boolean
+);
+
+-- Append only the listings that are new in the loaded months so that the existing auto_gen_listing_ids stay stable
+merge into datawarehouse.dim_listings
+using (
+    select
+    (select coalesce(max(auto_gen_listing_id), 0) from datawarehouse.dim_listings) + row_number() over (order by member_count desc) as auto_gen_listing_id,
+    original_listing_id, property_type, room_type, accomodates, has_availability
+    from (
+        select listing_id as original_listing_id, property_type, room_type, accomodates, has_availability, count(*) as member_count
+        from staging.listings
+        where month_year in {loaded_months}
+        group by original_listing_id, property_type, room_type, accomodates, has_availability
+    ) loaded_listings
+    where not exists (
+        select 1 from datawarehouse.dim_listings
+        where datawarehouse.dim_listings.original_listing_id is not distinct from loaded_listings.original_listing_id
+        and datawarehouse.dim_listings.property_type is not distinct from loaded_listings.property_type
+        and datawarehouse.dim_listings.room_type is not distinct from loaded_listings.room_type
+        and datawarehouse.dim_listings.accomodates is not distinct from loaded_listings.accomodates
+        and datawarehouse.dim_listings.has_availability is not distinct from loaded_listings.has_availability
+    )
+) new_listings
+on datawarehouse.dim_listings.original_listing_id is not distinct from new_listings.original_listing_id
+and datawarehouse.dim_listings.property_type is not distinct from new_listings.property_type
+and datawarehouse.dim_listings.room_type is not distinct from new_listings.room_type
+and datawarehouse.dim_listings.accomodates is not distinct from new_listings.accomodates
+and datawarehouse.dim_listings.has_availability is not distinct from new_listings.has_availability
+when not matched then insert (auto_gen_listing_id, original_listing_id, property_type, room_type, accomodates, has_availability)
+values (new_listings.auto_gen_listing_id, new_listings.original_listing_id, new_listings.property_type, new_listings.room_type, new_listings.accomodates, new_listings.has_availability);
+"""
+
+query_refresh_dim_host = f"""
+-- Create the host dimension table on the first run
+create table if not exists datawarehouse.dim_host (
+    auto_gen_host_id int primary key {constraint_properties}
+    , original_host_id int
+    , host_name varchar
+    , host_is_superhost boolean
+    , host_since date
+);
+
+-- Append only the hosts that are new in the loaded months so that the existing auto_gen_host_ids stay stable
+merge into datawarehouse.dim_host
+using (
+    select
+    (select coalesce(max(auto_gen_host_id), 0) from datawarehouse.dim_host) + row_number() over (order by member_count desc) as auto_gen_host_id,
+    original_host_id, host_name, host_is_superhost, host_since
+    from (
+        select host_id as original_host_id, host_name, host_is_superhost, host_since, count(*) as member_count
+        from staging.listings
+        where month_year in {loaded_months}
+        group by original_host_id, host_name, host_is_superhost, host_since
+    ) loaded_hosts
+    where not exists (
+        select 1 from datawarehouse.dim_host
+        where datawarehouse.dim_host.original_host_id is not distinct from loaded_hosts.original_host_id
+        and datawarehouse.dim_host.host_name is not distinct from loaded_hosts.host_name
+        and datawarehouse.dim_host.host_is_superhost is not distinct from loaded_hosts.host_is_superhost
+        and datawarehouse.dim_host.host_since is not distinct from loaded_hosts.host_since
+    )
+) new_hosts
+on datawarehouse.dim_host.original_host_id is not distinct from new_hosts.original_host_id
+and datawarehouse.dim_host.host_name is not distinct from new_hosts.host_name
+and datawarehouse.dim_host.host_is_superhost is not distinct from new_hosts.host_is_superhost
+and datawarehouse.dim_host.host_since is not distinct from new_hosts.host_since
+when not matched then insert (auto_gen_host_id, original_host_id, host_name, host_is_superhost, host_since)
+values (new_hosts.auto_gen_host_id, new_hosts.original_host_id, new_hosts.host_name, new_hosts.host_is_superhost, new_hosts.host_since);
+"""
+
+# dim_date is conformed across the cities, every city merges the months it loads into it before its fact table
+query_refresh_dim_date = f"""
+-- Create the dimension table for date on the first run
+create table if not exists datawarehouse.dim_date (
+    date_id int primary key {constraint_properties}
+    , month_year date
+);
+
+-- Append only the months that are new so that the existing date_ids stay stable. The date_id of a new month is
+-- derived from the month (YYYYMM), so a month gets the same date_id whichever city merges it first
+merge into datawarehouse.dim_date
+using (
+    select distinct year(month_year) * 100 + month(month_year) as date_id, month_year
+    from staging.listings
+    where month_year in {loaded_months}
+) new_months
+on datawarehouse.dim_date.month_year = new_months.month_year
+when not matched then insert (date_id, month_year)
+values (new_months.date_id, new_months.month_year);
+"""
+
+# The datamart tasks and the part 3 analyses filter and group the fact table by month and lga, so its
+# micro-partitions are clustered on these keys and the loaded rows are written in this order
+fact_listings_cluster_keys = "date_id, lga_code"
+
+query_refresh_fact_listings = f"""
+-- Create the fact table on the first run
+create table if not exists datawarehouse.fact_listings (
+    auto_gen_listing_id int
+    , auto_gen_host_id int
+    , lga_code int
+    , suburb_id int
+    , date_id int
+    , price int
+    , availability_30 int
+    , number_reviews int
+    , review_scores_ratings int
+{chr(10).join(f"    , constraint {name} foreign key ({column}) references {dimension} ({column}) {constraint_properties}"
+               for name, column, dimension in fact_listings_foreign_keys)}
+)
+cluster by ({fact_listings_cluster_keys});
+
+-- Cluster a fact table created by an earlier version, and look up the rows of a host without a full scan
+alter table datawarehouse.fact_listings cluster by ({fact_listings_cluster_keys});
+
+alter table datawarehouse.fact_listings add search optimization on equality(auto_gen_host_id);
+
+-- Resolve every distinct neighbourhood name of the loaded months to its lga and suburb ids once,
+-- so that the listings rows are matched with a plain equality on the name instead of a function-wrapped join
+create or replace transient table staging.neighbourhood_name_index as
+with neighbourhood_names as (
+    select host_neighbourhood as neighbourhood_name
+    from staging.listings
+    where month_year in {loaded_months}
+    union
+    select listing_neighbourhood
+    from staging.listings
+    where month_year in {loaded_months}
+), neighbourhood_keys as (
+    select neighbourhood_name, {name_key("neighbourhood_name")} as name_key
+    from neighbourhood_names
+    where neighbourhood_name is not null
+)
+select
+neighbourhood_keys.neighbourhood_name,
+neighbourhood_keys.name_key,
+staging.lga_name_index.lga_code,
+staging.lga_name_index.lga_name,
+datawarehouse.dim_suburb.suburb_id,
+datawarehouse.dim_suburb.suburb_name
+from neighbourhood_keys
+left join staging.lga_name_index on neighbourhood_keys.name_key = staging.lga_name_index.name_key
+left join staging.suburb_name_index on neighbourhood_keys.name_key = staging.suburb_name_index.name_key
+left join datawarehouse.dim_suburb on staging.suburb_name_index.suburb_id = datawarehouse.dim_suburb.suburb_id;
+
+-- Report the names that did not resolve to an lga or a suburb
+create or replace transient table staging.unmatched_names as
+select 'listing_neighbourhood' as name_kind, staging.listings.listing_neighbourhood as name, count(*) as row_count
+from staging.listings
+inner join staging.neighbourhood_name_index on staging.listings.listing_neighbourhood = staging.neighbourhood_name_index.neighbourhood_name
+where staging.listings.month_year in {loaded_months}
+and staging.neighbourhood_name_index.lga_code is null
+group by staging.listings.listing_neighbourhood
+union all
+select 'host_neighbourhood' as name_kind, staging.listings.host_neighbourhood as name, count(*) as row_count
+from staging.listings
+inner join staging.neighbourhood_name_index on staging.listings.host_neighbourhood = staging.neighbourhood_name_index.neighbourhood_name
+where staging.listings.month_year in {loaded_months}
+and staging.neighbourhood_name_index.suburb_id is null
+group by staging.listings.host_neighbourhood
+union all
+select 'suburb_lga_name' as name_kind, suburb_lga_name as name, count(*) as row_count
+from staging.lga_code_suburb
+where lga_code is null
+group by suburb_lga_name;
+
+-- The intermediary table of earlier versions is no longer written, drop it so that it does not keep its storage
+drop table if exists datawarehouse.temp_listings_lga_suburb;
+
+-- Record the hosts whose fact rows are replaced, before and after the load, for the host level datamart tables.
+-- They are kept with the pending months, so a failed run does not lose the hosts of the fact rows it replaced
+create table if not exists staging.loaded_hosts (
+    original_host_id int
+);
+
+insert into staging.loaded_hosts
+select original_host_id
+from (
+    select datawarehouse.dim_host.original_host_id
+    from datawarehouse.fact_listings
+    inner join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
+    where datawarehouse.fact_listings.date_id in (
+        select date_id from datawarehouse.dim_date
+        where month_year in {loaded_months}
+    )
+    union
+    select host_id as original_host_id
+    from staging.listings
+    where month_year in {loaded_months}
+) replaced_hosts
+where original_host_id is not null
+and not exists (
+    select 1 from staging.loaded_hosts
+    where staging.loaded_hosts.original_host_id = replaced_hosts.original_host_id
+);
+
+-- Replace the fact rows of the loaded months in one transaction
+begin;
+
+delete from datawarehouse.fact_listings
+where date_id in (
+    select date_id from datawarehouse.dim_date
+    where month_year in {loaded_months}
+);
+
+-- Project only the keys and measures of the fact table straight from the listings of the loaded months
+-- joined with the listings, host, lga, date and suburb lookups, in the order of the clustering keys
+insert into datawarehouse.fact_listings
+select
+datawarehouse.dim_listings.auto_gen_listing_id,
+datawarehouse.dim_host.auto_gen_host_id,
+listing_lga.lga_code,
+host_suburb.suburb_id,
+datawarehouse.dim_date.date_id,
+staging.listings.price,
+staging.listings.availability_30,
+staging.listings.number_reviews,
+staging.listings.review_scores_ratings
+from staging.listings
+left join staging.neighbourhood_name_index listing_lga on staging.listings.listing_neighbourhood = listing_lga.neighbourhood_name
+left join staging.neighbourhood_name_index host_suburb on staging.listings.host_neighbourhood = host_suburb.neighbourhood_name
+left join datawarehouse.dim_date on staging.listings.month_year = datawarehouse.dim_date.month_year
+left join datawarehouse.dim_listings on staging.listings.listing_id = datawarehouse.dim_listings.original_listing_id and staging.listings.property_type = datawarehouse.dim_listings.property_type and staging.listings.room_type = datawarehouse.dim_listings.room_type and staging.listings.accomodates = datawarehouse.dim_listings.accomodates and staging.listings.has_availability = datawarehouse.dim_listings.has_availability
+left join datawarehouse.dim_host on staging.listings.host_id = datawarehouse.dim_host.original_host_id and staging.listings.host_name = datawarehouse.dim_host.host_name and staging.listings.host_is_superhost = datawarehouse.dim_host.host_is_superhost and staging.listings.host_since = datawarehouse.dim_host.host_since
+where staging.listings.month_year in {loaded_months}
+order by datawarehouse.dim_date.date_id, listing_lga.lga_code;
+
+commit;
+"""
+
+# Violations of the fact table constraints: foreign keys without a dimension row, and duplicate primary keys
+# of the dimension tables. Every check should count 0
+referential_integrity_checks = {
+    **{
+        name: f"count_if(datawarehouse.fact_listings.{column} is not null and {dimension}.{column} is null)"
+        for name, column, dimension in fact_listings_foreign_keys
+    },
+    **{
+        f"{dimension.split('.')[1]}_pk": f"(select count(*) - count(distinct {column}) from {dimension})"
+        for name, column, dimension in fact_listings_foreign_keys
+    },
+}
+
+
+def referential_integrity_sql():
+    # All the checks in one pass over the fact rows of the loaded months, the earlier months were checked when loaded
+    joins = [
+        f"left join {dimension} on datawarehouse.fact_listings.{column} = {dimension}.{column}"
+        for name, column, dimension in fact_listings_foreign_keys
+    ]
+    return f"""
+select
+{("," + chr(10)).join(f"    {check} as {name}" for name, check in referential_integrity_checks.items())}
+from datawarehouse.fact_listings
+{chr(10).join(joins)}
+where datawarehouse.fact_listings.date_id in (
+    select date_id from datawarehouse.dim_date
+    where month_year in {loaded_months}
+)
+"""
+
+
+query_referential_integrity = referential_integrity_sql()
+
+# Average depth and overlaps of the fact table micro-partitions on its clustering keys, as a JSON string
+query_fact_clustering_information = f"""
+select system$clustering_information('datawarehouse.fact_listings', '({fact_listings_cluster_keys})')
+"""
+
+query_unmatched_names = """
+select name_kind, name, row_count
+from staging.unmatched_names
+order by row_count desc
+"""
+
+# Additive aggregates and mergeable sketch states kept per (group, month), shared by the datamart tables
+# of that grain and by their rollups: sums and counts add up across groups and months, hll_combine merges
+# the HyperLogLog states of distinct hosts and approx_percentile_combine merges the t-digest states of price
+kpi_state_columns = """
+    count(case when has_availability = TRUE then 1 END) as total_active_listings,
+    count(case when has_availability = FALSE then 1 END) as total_inactive_listings,
+    count(case when has_availability = TRUE or has_availability = FALSE then 1 END) as total_listings,
+    min(case when has_availability = TRUE then price END) as min_price,
+    max(case when has_availability = TRUE then price END) as max_price,
+    approx_percentile_accumulate(case when has_availability = TRUE then price END) as price_digest,
+    sum(case when has_availability = TRUE then price END) as sum_price,
+    count(case when has_availability = TRUE then price END) as count_price,
+    count(distinct(original_host_id)) as distinct_hosts,
+    count(distinct(case when host_is_superhost = TRUE then original_host_id END)) as distinct_superhosts,
+    hll_accumulate(original_host_id) as hosts_hll,
+    hll_accumulate(case when host_is_superhost = TRUE then original_host_id END) as superhosts_hll,
+    sum(case when has_availability = TRUE then review_scores_ratings END) as sum_review_scores_ratings,
+    count(case when has_availability = TRUE then review_scores_ratings END) as count_review_scores_ratings,
+    sum(case when has_availability = TRUE then (30-availability_30) END) as total_stays,
+    sum((30 - availability_30)*price) as estimated_revenue,
+    sum(case when has_availability = TRUE then ((30 - availability_30)*price) END) as estimated_revenue_active_listing,
+    count(case when has_availability = TRUE then ((30 - availability_30)*price) END) as count_estimated_revenue_active_listing"""
+
+# Rows from this month on may get a different month-over-month change when the loaded months are refreshed
+first_loaded_month = "(select min(month_year) from staging.listings_pending_months)"
+
+
+def incremental_refresh_sql(table, select_sql, refreshed_rows, cluster_by=None, transient=False):
+    # Create the table on the first run, then replace only the refreshed rows instead of the whole table
+    cluster = f"\ncluster by ({cluster_by})" if cluster_by else ""
+    kind = "transient table" if transient else "table"
+    return f"""
+create {kind} if not exists {table}{cluster} as
+{select_sql.strip()}
+limit 0;
+
+delete from {table}
+where {refreshed_rows};
+
+insert into {table}
+{select_sql.strip()};
+"""
+
+
+fact_listings_wide_select = f"""
+select
+datawarehouse.fact_listings.auto_gen_listing_id,
+datawarehouse.fact_listings.auto_gen_host_id,
+datawarehouse.fact_listings.lga_code,
+datawarehouse.fact_listings.suburb_id,
+datawarehouse.fact_listings.date_id,
+datawarehouse.fact_listings.price,
+datawarehouse.fact_listings.availability_30,
+datawarehouse.fact_listings.number_reviews,
+datawarehouse.fact_listings.review_scores_ratings,
+datawarehouse.dim_lga.lga_name,
+datawarehouse.dim_date.month_year,
+datawarehouse.dim_listings.original_listing_id,
+datawarehouse.dim_listings.property_type,
+datawarehouse.dim_listings.room_type,
+datawarehouse.dim_listings.accomodates,
+datawarehouse.dim_listings.has_availability,
+datawarehouse.dim_host.original_host_id,
+datawarehouse.dim_host.host_is_superhost,
+datawarehouse.dim_suburb.suburb_name
+from datawarehouse.fact_listings
+left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
+left join datawarehouse.dim_date on datawarehouse.fact_listings.date_id = datawarehouse.dim_date.date_id
+left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
+left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
+left join datawarehouse.dim_suburb on datawarehouse.fact_listings.suburb_id = datawarehouse.dim_suburb.suburb_id
+where datawarehouse.fact_listings.date_id in (select date_id from datawarehouse.dim_date where month_year in {loaded_months})
+order by month_year"""
+
+query_refresh_fact_listings_wide = f"""
+-- Refresh the wide denormalized fact table that the datamart tables aggregate from instead of each repeating the joins,
+-- only the fact rows of the loaded months are joined again
+{incremental_refresh_sql("datawarehouse.fact_listings_wide", fact_listings_wide_select, f"month_year in {loaded_months}",
+                         cluster_by="month_year", transient=True)}"""
+
+
+def kpi_window_source(kpi_table, keys):
+    # The kpi rows from the first loaded month on, plus the latest earlier row of every group as the base of lag
+    return f"""
+        select * from {kpi_table}
+        where month_year >= {first_loaded_month}
+        union all
+        select * from {kpi_table}
+        where month_year < {first_loaded_month}
+        qualify row_number() over(partition by {keys} order by month_year desc) = 1"""
+
+
+kpi_lga_month_select = f"""
+select
+    lga_name,
+    month_year,
+{kpi_state_columns}
+from datawarehouse.fact_listings_wide
+where month_year in {loaded_months}
+group by lga_name, month_year"""
+
+query_refresh_kpi_lga_month = f"""
+-- Refresh the kpi state table per listing lga and month that the listing and host neighbourhood datamart tables read,
+-- only the loaded months are aggregated again
+{incremental_refresh_sql("datawarehouse.kpi_lga_month", kpi_lga_month_select, f"month_year in {loaded_months}")}"""
+
+kpi_property_type_month_select = f"""
+select
+    property_type,
+    room_type,
+    accomodates,
+    month_year,
+{kpi_state_columns}
+from datawarehouse.fact_listings_wide
+where month_year in {loaded_months}
+group by property_type, room_type, accomodates, month_year"""
+
+query_refresh_kpi_property_type_month = f"""
+-- Refresh the kpi state table per property_type, room_type, accomodates and month that the property type datamart tables read,
+-- only the loaded months are aggregated again
+{incremental_refresh_sql("datawarehouse.kpi_property_type_month", kpi_property_type_month_select, f"month_year in {loaded_months}")}"""
+
+datamart_listing_neighbourhood_select = f"""
+with listing_neighbourhood_stats as (
+    select
+    lga_name as listing_neighbourhood, 
+    month_year,
+    total_active_listings,
+    total_inactive_listings,
+    total_listings,
+    min_price,
+    max_price,
+    approx_percentile_estimate(price_digest, 0.5) as median_price,
+    sum_price / nullif(count_price, 0) as avg_price,
+    distinct_hosts,
+    distinct_superhosts,
+    sum_review_scores_ratings / nullif(count_review_scores_ratings, 0) as avg_review_scores_ratings,
+    total_stays,
+    estimated_revenue_active_listing / nullif(count_estimated_revenue_active_listing, 0) as avg_estimated_revenue_per_active_listing,
+    lag(total_active_listings) over(partition by lga_name order by month_year) as previous_active_listings,
+    lag(total_inactive_listings) over(partition by lga_name order by month_year) as previous_inactive_listings
+    from ({kpi_window_source("datawarehouse.kpi_lga_month", "lga_name")}
+    ) kpi_window
+)
+select 
+listing_neighbourhood,
+month_year,
+case when total_listings = 0 then null else (total_active_listings/total_listings)*100 END as active_listings_rate,
+min_price,
+max_price,
+median_price,
+avg_price,
+distinct_hosts,
+case when distinct_hosts = 0 then null else (distinct_superhosts/distinct_hosts)*100 END as superhost_rate,
+avg_review_scores_ratings,
+case when previous_active_listings = 0 then null else ((total_active_listings - previous_active_listings)/previous_active_listings)*100 END as per_change_active_listings,
+case when previous_inactive_listings = 0 then null else ((total_inactive_listings - previous_inactive_listings)/previous_inactive_listings)*100 END as per_change_inactive_listings,
+total_stays,
+avg_estimated_revenue_per_active_listing
+from listing_neighbourhood_stats
+where month_year >= {first_loaded_month}"""
+
+query_datamart_listing_neighbourhood = f"""
+-- Refresh the listing_neighbourhood table for datamart schema grouping by listing_neighbourhood and month_year
+-- from the first loaded month on, the earlier months keep their rows
+{incremental_refresh_sql("datamart.dm_listing_neighbourhood", datamart_listing_neighbourhood_select, f"month_year >= {first_loaded_month}")}"""
+
+datamart_property_type_select = f"""
+with property_type_stats as (
+    select
+    property_type,
+    room_type,
+    accomodates,
+    month_year,
+    total_active_listings,
+    total_inactive_listings,
+    total_listings,
+    min_price,
+    max_price,
+    approx_percentile_estimate(price_digest, 0.5) as median_price,
+    sum_price / nullif(count_price, 0) as avg_price,
+    distinct_hosts,
+    distinct_superhosts,
+    sum_review_scores_ratings / nullif(count_review_scores_ratings, 0) as avg_review_scores_ratings,
+    total_stays,
+    estimated_revenue_active_listing / nullif(count_estimated_revenue_active_listing, 0) as avg_estimated_revenue_per_active_listing,
+    lag(total_active_listings) over(partition by property_type, room_type, accomodates order by month_year) as previous_active_listings,
+    lag(total_inactive_listings) over(partition by property_type, room_type, accomodates order by month_year) as previous_inactive_listings
+    from ({kpi_window_source("datawarehouse.kpi_property_type_month", "property_type, room_type, accomodates")}
+    ) kpi_window
+)
+select 
+property_type,
+room_type,
+accomodates,
+month_year,
+case when total_listings = 0 then null else (total_active_listings/total_listings)*100 END as active_listings_rate,
+min_price,
+max_price,
+median_price,
+avg_price,
+distinct_hosts,
+case when distinct_hosts = 0 then null else (distinct_superhosts/distinct_hosts)*100 END as superhost_rate,
+avg_review_scores_ratings,
+case when previous_active_listings = 0 then null else ((total_active_listings - previous_active_listings)/previous_active_listings)*100 END as per_change_active_listings,
+case when previous_inactive_listings = 0 then null else ((total_inactive_listings - previous_inactive_listings)/previous_inactive_listings)*100 END as per_change_inactive_listings,
+total_stays,
+avg_estimated_revenue_per_active_listing
+from property_type_stats
+where month_year >= {first_loaded_month}"""
+
+query_refresh_datamart_property_type = f"""
+-- Refresh the property_type table for datamart schema grouping by property_type, room_type, accomodates, month_year
+-- from the first loaded month on, the earlier months keep their rows
+{incremental_refresh_sql("datamart.dm_property_type", datamart_property_type_select, f"month_year >= {first_loaded_month}")}"""
+
+datamart_host_neighbourhood_select = f"""
+select 
+lga_name as host_neighbourhood_lga,
+month_year,
+distinct_hosts,
+estimated_revenue,
+estimated_revenue_active_listing/distinct_hosts as estimated_revenue_per_host
+from datawarehouse.kpi_lga_month
+where month_year in {loaded_months}"""
+
+query_refresh_datamart_host_neighbourhood = f"""
+-- Refresh the host_neighbourhood table for datamart schema grouping by host_neighbourhood_lga, month_year for the loaded months
+{incremental_refresh_sql("datamart.dm_host_neighbourhood", datamart_host_neighbourhood_select, f"month_year in {loaded_months}")}"""
+
+# Rollups merge the sketch states of the monthly kpi tables instead of scanning the fact table again
+rollup_kpi_columns = """
+    sum(total_listings) as total_listings,
+    case when sum(total_listings) = 0 then null else (sum(total_active_listings)/sum(total_listings))*100 END as active_listings_rate,
+    min(min_price) as min_price,
+    max(max_price) as max_price,
+    approx_percentile_estimate(approx_percentile_combine(price_digest), 0.5) as median_price,
+    sum(sum_price) / nullif(sum(count_price), 0) as avg_price,
+    hll_estimate(hll_combine(hosts_hll)) as distinct_hosts,
+    case when hll_estimate(hll_combine(hosts_hll)) = 0 then null else (hll_estimate(hll_combine(superhosts_hll))/hll_estimate(hll_combine(hosts_hll)))*100 END as superhost_rate,
+    sum(sum_review_scores_ratings) / nullif(sum(count_review_scores_ratings), 0) as avg_review_scores_ratings,
+    sum(total_stays) as total_stays,
+    sum(estimated_revenue_active_listing) / nullif(sum(count_estimated_revenue_active_listing), 0) as avg_estimated_revenue_per_active_listing"""
+
+query_refresh_datamart_listing_neighbourhood_all_months = f"""
+-- Create a listing_neighbourhood table for datamart schema over all the loaded months by merging the monthly states
+create or replace table datamart.dm_listing_neighbourhood_all_months as
+select
+    lga_name as listing_neighbourhood,
+    min(month_year) as first_month_year,
+    max(month_year) as last_month_year,
+{rollup_kpi_columns}
+from datawarehouse.kpi_lga_month
+group by listing_neighbourhood;
+"""
+
+datamart_room_type_select = f"""
+select
+    property_type,
+    room_type,
+    month_year,
+{rollup_kpi_columns}
+from datawarehouse.kpi_property_type_month
+where month_year in {loaded_months}
+group by property_type, room_type, month_year"""
+
+query_refresh_datamart_room_type = f"""
+-- Refresh the room_type table for datamart schema grouping by property_type, room_type and month_year across accomodates
+-- for the loaded months
+{incremental_refresh_sql("datamart.dm_room_type", datamart_room_type_select, f"month_year in {loaded_months}")}"""
+
+
+# Host level analyses of part_3.sql over all the months of a host. A host's rows only depend on the fact rows
+# of that host, so only the hosts that had or have listings in the loaded months are computed again
+loaded_hosts = "(select original_host_id from staging.loaded_hosts)"
+
+
+hosts_lga_same_as_listing_lga_select = f"""
+with hosts_multiple_listings as (
+    select 
+    original_host_id,
+    count(distinct(original_listing_id)) as num_listings
+    from datawarehouse.fact_listings_wide
+    where original_host_id in {loaded_hosts}
+    group by original_host_id
+    having num_listings > 1
+),
+hosts_lga as (
+    select distinct
+    lga_name as host_lga,
+    auto_gen_host_id,
+    original_host_id
+    from datawarehouse.fact_listings_wide
+    where suburb_name is not null
+    and original_host_id in {loaded_hosts}
+),
+listings_lga as (
+    select distinct
+    auto_gen_host_id,
+    lga_name as listing_lga
+    from datawarehouse.fact_listings_wide
+    where original_host_id in {loaded_hosts}
+)
+select distinct
+hosts_lga.auto_gen_host_id,
+hosts_lga.original_host_id,
+host_lga,
+listing_lga,
+case when host_lga = listing_lga then TRUE else FALSE END as hosts_lga_same_as_listing_lga,
+num_listings
+from hosts_lga
+inner join listings_lga on hosts_lga.auto_gen_host_id = listings_lga.auto_gen_host_id
+inner join hosts_multiple_listings on hosts_lga.original_host_id = hosts_multiple_listings.original_host_id
+order by listing_lga"""
+
+query_refresh_datamart_hosts_lga_same_as_listing_lga = f"""
+-- Part 3c: refresh whether the hosts with multiple listings have their listings in the same lga as they live,
+-- for the hosts with listings in the loaded months
+{incremental_refresh_sql("datamart.hosts_lga_same_as_listing_lga", hosts_lga_same_as_listing_lga_select,
+                         f"original_host_id in {loaded_hosts}", cluster_by="listing_lga")}"""
+
+hosts_can_cover_mortgage_select = f"""
+with hosts_annual_revenue as (
+    select 
+    original_host_id,
+    count(distinct(original_listing_id)) as num_listings,
+    sum(case when has_availability = TRUE then ((30-availability_30)*price) END) as estimated_annual_revenue
+    from datawarehouse.fact_listings_wide
+    where original_host_id in {loaded_hosts}
+    group by original_host_id
+    having num_listings = 1
+),
+annualised_mortgage_revenue as (
+    select distinct
+    original_host_id,
+    datawarehouse.fact_listings_wide.lga_name as listing_neighbourhood,
+    median_mortgage_repay_monthly*12 as annualised_median_mortgage
+    from datawarehouse.fact_listings_wide
+    left join datawarehouse.dim_lga on datawarehouse.fact_listings_wide.lga_code = datawarehouse.dim_lga.lga_code
+    where original_host_id in {loaded_hosts}
+)
+select 
+hosts_annual_revenue.original_host_id, 
+listing_neighbourhood,
+estimated_annual_revenue,
+annualised_median_mortgage,
+estimated_annual_revenue >= annualised_median_mortgage as can_cover_mortgage
+from hosts_annual_revenue
+inner join annualised_mortgage_revenue on hosts_annual_revenue.original_host_id = annualised_mortgage_revenue.original_host_id
+order by listing_neighbourhood"""
+
+query_refresh_datamart_hosts_can_cover_mortgage = f"""
+-- Part 3d: refresh whether the hosts with a unique listing can cover the annualised median mortgage repayment
+-- with their estimated revenue, for the hosts with listings in the loaded months
+{incremental_refresh_sql("datamart.hosts_can_cover_mortgage", hosts_can_cover_mortgage_select,
+                         f"original_host_id in {loaded_hosts}", cluster_by="listing_neighbourhood")}"""
+
+
+# Datamart tables that are exported for the BI tools and the columns that identify a row
+datamart_tables = {
+    "dm_listing_neighbourhood": ("listing_neighbourhood", "month_year"),
+    "dm_property_type": ("property_type", "room_type", "accomodates", "month_year"),
+    "dm_host_neighbourhood": ("host_neighbourhood_lga", "month_year"),
+    "dm_listing_neighbourhood_all_months": ("listing_neighbourhood",),
+    "dm_room_type": ("property_type", "room_type", "month_year"),
+    "hosts_lga_same_as_listing_lga": ("original_host_id", "auto_gen_host_id", "host_lga", "listing_lga"),
+    "hosts_can_cover_mortgage": ("original_host_id", "listing_neighbourhood"),
+}
+
+# Order-independent hash of the content of a datamart table, computed in the warehouse without fetching the rows
+query_datamart_content_hash = """
+select hash_agg(*) as content_hash, count(*) as row_count
+from datamart.{table}
+"""
+
+query_datamart_export = """
+select *
+from datamart.{table}
+order by {keys}
+"""
+
+
+query_refresh_listings_pending_months = """
+-- Every table of the pending months is loaded, so the next run only loads the months staged after this one
+delete from staging.listings_pending_months;
+
+delete from staging.loaded_hosts;
+"""
+
+
+# External table loaded by each staging table and the city of the external table, the DAG skips a staging table
+# and the tables built only from it when the files behind its external table are unchanged since the last load
+staging_sources = {
+    "staging_nsw_lga_code": ("nsw_lga_code", default_city),
+    **{f"staging_{table}": (table, default_city) for table in census_packs},
+    "staging_nsw_lga_suburb": ("nsw_lga_suburb", default_city),
+    **{city_table("staging_listings", city): ("listings", city) for city in cities},
+}
+
+# Tables built once from the lga, suburb and census files and shared by every city.
+# The files of a lookup table are recorded once the dimensions built from it are loaded, not by its staging task,
+# so a failed dimension is built again by the next run instead of being skipped with its unchanged files.
+# dim_suburb runs after dim_lga, in spec order and in the session of the lookup dimensions of the DAG,
+# so it records the lga code files that both of them read
+shared_table_tasks = {
+    "staging_nsw_lga_code": (query_refresh_staging_nsw_lga_code, []),
+    **{f"staging_{table}": (census_staging_sql(table), []) for table in census_packs},
+    "staging_nsw_lga_suburb": (query_refresh_staging_nsw_lga_suburb, []),
+    "dim_lga": (
+        query_refresh_dim_lga + query_requeue_listings_months + "".join(map(record_stage_files_sql, census_packs)),
+        ["staging_nsw_lga_code", *(f"staging_{table}" for table in census_packs)],
+    ),
+    "dim_suburb": (
+        query_refresh_dim_suburb + query_requeue_listings_months
+        + record_stage_files_sql("nsw_lga_code") + record_stage_files_sql("nsw_lga_suburb"),
+        ["staging_nsw_lga_code", "staging_nsw_lga_suburb"],
+    ),
+}
+
+# Tables built for every city from its listings feed, in the schemas of the city
+city_table_tasks = {
+    "staging_listings": (query_refresh_staging_listings + record_stage_files_sql("listings"), []),
+    "dim_listings": (query_refresh_dim_listings, ["staging_listings"]),
+    "dim_host": (query_refresh_dim_host, ["staging_listings"]),
+    "dim_date": (query_refresh_dim_date, ["staging_listings"]),
+    "fact_listings": (query_refresh_fact_listings, ["dim_lga", "dim_suburb", "dim_listings", "dim_host", "dim_date"]),
+    "fact_listings_wide": (query_refresh_fact_listings_wide, ["fact_listings"]),
+    "kpi_lga_month": (query_refresh_kpi_lga_month, ["fact_listings_wide"]),
+    "kpi_property_type_month": (query_refresh_kpi_property_type_month, ["fact_listings_wide"]),
+    "datamart_listing_neighbourhood": (query_datamart_listing_neighbourhood, ["kpi_lga_month"]),
+    "datamart_property_type": (query_refresh_datamart_property_type, ["kpi_property_type_month"]),
+    "datamart_host_neighbourhood": (query_refresh_datamart_host_neighbourhood, ["kpi_lga_month"]),
+    "datamart_listing_neighbourhood_all_months": (query_refresh_datamart_listing_neighbourhood_all_months, ["kpi_lga_month"]),
+    "datamart_room_type": (query_refresh_datamart_room_type, ["kpi_property_type_month"]),
+    "datamart_hosts_lga_same_as_listing_lga": (query_refresh_datamart_hosts_lga_same_as_listing_lga, ["fact_listings_wide"]),
+    "datamart_hosts_can_cover_mortgage": (query_refresh_datamart_hosts_can_cover_mortgage, ["fact_listings_wide"]),
+}
+# Cleared last, once every table of the pending months of the city is loaded
+city_table_tasks["listings_pending_months"] = (
+    query_refresh_listings_pending_months, [table for table in city_table_tasks if table.startswith("datamart_")]
+)
+
+
+def city_tasks(city, tables):
+    # Task spec entries of a city, its upstream tables point at the tables of the same city or at the shared ones
+    return {
+        city_table(table, city): (
+            city_sql(sql, city),
+            [city_table(upstream, city) if upstream in city_table_tasks else upstream for upstream in upstream_tables],
+        )
+        for table, (sql, upstream_tables) in city_table_tasks.items() if table in tables
+    }
+
+
+# One DAG task per table: table -> (sql, tables whose tasks have to finish first).
+# Listed in an order that respects the dependencies, tables without a path between them load concurrently,
+# so the cities load in parallel once the lga and suburb dimensions are built
+table_tasks = {
+    **shared_table_tasks,
+    **{name: task for city in cities for name, task in city_tasks(city, list(city_table_tasks)).items()},
+}
+
+
+def table_task_id(table):
+    return f"refresh_{table}_task"
@@ -0,0 +1,200 @@
+import os
+import re
+import csv
+import glob
+import json
+import argparse
+import logging
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from bde_at3_sql import listings_columns, listings_column_count, csv_null_values, python_date_format
+
+
+#########################################################
+#
+#   Validation Settings
+#
+#########################################################
+
+# Rows read per chunk, only one chunk per worker is held in memory
+chunk_rows = 50000
+
+# A file fails when more than this fraction of its rows has a value that staging cannot cast
+max_bad_row_fraction = float(os.environ.get("BDE_MAX_BAD_ROW_FRACTION", "0.001"))
+
+# A file fails when it has fewer rows than this fraction of the median row count of the files validated with it
+min_row_count_fraction = 0.5
+
+# Bad values written to the quarantine file per file, the summary still counts all of them
+quarantine_values_per_file = 1000
+
+# Strings that Snowflake casts to a boolean
+boolean_values = {"true", "false", "t", "f", "yes", "no", "y", "n", "on", "off", "1", "0"}
+
+numeric_pattern = r"[-+]?(\d+\.?\d*|\.\d+)"
+
+summary_file_name = "listings_validation_summary.json"
+quarantine_file_name = "listings_quarantine.csv"
+
+
+#########################################################
+#
+#   Column Checks
+#
+#########################################################
+
+def listings_checks():
+    # Column position -> (staging column name, type, date format) derived from the staging projection
+    checks = {}
+    for name, column_type, expression in listings_columns:
+        cast = re.fullmatch(r"value:c(\d+)", expression)
+        to_date = re.fullmatch(r"to_date\(value:c(\d+)::varchar, '([^']*)'\)", expression)
+        if cast:
+            checks[int(cast.group(1))] = (name, column_type, None)
+        elif to_date:
+            checks[int(to_date.group(1))] = (name, "date", python_date_format(to_date.group(2)))
+    return checks
+
+
+def invalid_values(values, column_type, date_format):
+    # Boolean mask of the non-null values that the staging cast would reject
+    present = values.notna() & ~values.isin(csv_null_values)
+    if column_type in ("int", "bigint", "float"):
+        valid = values.str.fullmatch(numeric_pattern)
+    elif column_type == "boolean":
+        valid = values.str.lower().isin(boolean_values)
+    elif column_type == "date":
+        valid = pd.to_datetime(values, format=date_format or "ISO8601", errors="coerce").notna()
+    else:
+        return pd.Series(False, index=values.index)
+    return present & ~valid.fillna(False).astype(bool)
+
+
+#########################################################
+#
+#   File Validation
+#
+#########################################################
+
+def validate_listings_file(path):
+    # Streams one listings file in chunks and returns its summary with the first quarantined values
+    stat = os.stat(path)
+    result = {
+        "file_name": os.path.basename(path),
+        "file_size": stat.st_size,
+        "last_modified": stat.st_mtime,
+        "rows": 0,
+        "bad_rows": 0,
+        "bad_values": {},
+        "errors": [],
+        "quarantine": [],
+    }
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f), [])
+    if len(header) != listings_column_count:
+        result["errors"].append(f"header has {len(header)} columns, expected {listings_column_count}")
+        return result
+
+    checks = listings_checks()
+    column_names = [f"c{i}" for i in range(1, listings_column_count + 1)]
+    try:
+        chunks = pd.read_csv(path, names=column_names, skiprows=1, dtype=str, keep_default_na=False,
+                             encoding="utf-8-sig", chunksize=chunk_rows)
+        for chunk in chunks:
+            bad_rows = pd.Series(False, index=chunk.index)
+            for position, (name, column_type, date_format) in checks.items():
+                invalid = invalid_values(chunk[f"c{position}"], column_type, date_format)
+                if not invalid.any():
+                    continue
+                bad_rows |= invalid
+                result["bad_values"][name] = result["bad_values"].get(name, 0) + int(invalid.sum())
+                for index, value in chunk.loc[invalid, f"c{position}"].items():
+                    if len(result["quarantine"]) >= quarantine_values_per_file:
+                        break
+                    # Data rows are numbered from 1, after the header
+                    result["quarantine"].append((index + 1, name, value, f"not a valid {column_type}"))
+            result["rows"] += len(chunk)
+            result["bad_rows"] += int(bad_rows.sum())
+    except pd.errors.ParserError as e:
+        result["errors"].append(f"unparseable csv: {e}")
+
+    if result["rows"] == 0:
+        result["errors"].append("no rows")
+    elif result["bad_rows"] > result["rows"] * max_bad_row_fraction:
+        result["errors"].append(f"{result['bad_rows']} of {result['rows']} rows have values that cannot be cast")
+    return result
+
+
+def validate_listings(listings_dir, output_dir, max_workers=None):
+    # Validates the new or changed listings files across a process pool, then writes the quarantine file
+    # and the summary to output_dir. Files that passed before and are unchanged are not read again.
+    os.makedirs(output_dir, exist_ok=True)
+    summary_path = os.path.join(output_dir, summary_file_name)
+    previous = {}
+    if os.path.exists(summary_path):
+        with open(summary_path) as f:
+            previous = {file["file_name"]: file for file in json.load(f)["files"]}
+
+    paths = sorted(glob.glob(os.path.join(listings_dir, "*.csv")))
+    files, pending = [], []
+    for path in paths:
+        stat = os.stat(path)
+        known = previous.get(os.path.basename(path))
+        if known and not known["errors"] and known["file_size"] == stat.st_size and known["last_modified"] == stat.st_mtime:
+            files.append(known)
+        else:
+            pending.append(path)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        validated = list(pool.map(validate_listings_file, pending))
+    files.extend(validated)
+    files.sort(key=lambda file: file["file_name"])
+
+    # A file with far fewer rows than the other months is most likely a truncated upload
+    row_counts = [file["rows"] for file in files if file["rows"]]
+    if len(row_counts) >= 3:
+        median_rows = statistics.median(row_counts)
+        for file in validated:
+            if 0 < file["rows"] < median_rows * min_row_count_fraction:
+                file["errors"].append(f"{file['rows']} rows, the median of the listings files is {median_rows:g}")
+
+    with open(os.path.join(output_dir, quarantine_file_name), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file_name", "row_number", "column_name", "value", "reason"])
+        for file in validated:
+            for row_number, column_name, value, reason in file.pop("quarantine"):
+                writer.writerow([file["file_name"], row_number, column_name, value, reason])
+
+    summary = {
+        "files": files,
+        "validated_files": len(validated),
+        "invalid_files": [file["file_name"] for file in files if file["errors"]],
+        "rows": sum(file["rows"] for file in files),
+        "bad_rows": sum(file["bad_rows"] for file in files),
+    }
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the listings csv files before they are loaded into the warehouse")
+    parser.add_argument("--listings-dir", required=True, help="directory with the MM_YYYY.csv listings files")
+    parser.add_argument("--output-dir", required=True, help="directory for the quarantine file and the summary")
+    parser.add_argument("--max-workers", type=int, help="number of worker processes, the number of cpus by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    summary = validate_listings(args.listings_dir, args.output_dir, args.max_workers)
+    for file in summary["files"]:
+        logging.info("%s: %d rows, %d bad rows %s", file["file_name"], file["rows"], file["bad_rows"],
+                     "; ".join(file["errors"]) or "ok")
+    if summary["invalid_files"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
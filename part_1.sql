@@ -4,6 +4,27 @@ Create database bde_at_3;
 -- Use that database
 Use bde_at_3;
 
+-- Create the warehouses of the execution profiles of the DAG: the lookup loads and the reports run on the
+-- x-small warehouse, staging, dimensions and datamarts on the small one and the fact build on the medium one.
+-- They resume on the first statement of a task and suspend after a minute without queries
+create warehouse if not exists bde_xsmall_wh
+warehouse_size = 'XSMALL'
+auto_suspend = 60
+auto_resume = true
+initially_suspended = true;
+
+create warehouse if not exists bde_small_wh
+warehouse_size = 'SMALL'
+auto_suspend = 60
+auto_resume = true
+initially_suspended = true;
+
+create warehouse if not exists bde_medium_wh
+warehouse_size = 'MEDIUM'
+auto_suspend = 60
+auto_resume = true
+initially_suspended = true;
+
 -- Create a schema called raw for the raw layer
 Create schema raw;
 
@@ -59,8 +80,12 @@ NULL_IF = ('\\N', 'NULL', 'NUL', '')
 FIELD_OPTIONALLY_ENCLOSED_BY = '"'
 ;
 
--- Create an external table for all the listings csv files
-create or replace external table raw.listings
+-- Create an external table for all the listings csv files, partitioned by the month in the file name
+-- so that incremental loads only read the new or changed files
+create or replace external table raw.listings (
+    file_month_year varchar as split_part(substr(metadata$filename, 15), '.', 0)
+)
+partition by (file_month_year)
 with location = @stage_gcp_listings 
 file_format = file_format_csv
 pattern = '.*[.]csv';
@@ -104,6 +129,69 @@ pattern = '.*2016Census_G02_NSW_LGA.csv';
 -- Check the row count of the external table: raw.go2_census
 select count(*) from raw.go2_census;
 
+------- PARQUET INGESTION --------
+
+-- bde_at3_parquet.py converts the listings and census csv files to typed, snappy compressed Parquet files
+-- with the same c1..cN column names before they are uploaded next to the csv files.
+-- Run this block instead of the csv external tables above when the DAG runs with BDE_INGEST_FORMAT=parquet:
+-- the staging SQL is unchanged and only the Parquet columns that it projects are scanned.
+
+-- Create a file format for Parquet files
+create or replace file format file_format_parquet
+type = 'PARQUET'
+compression = 'AUTO'
+;
+
+create or replace external table raw.listings (
+    file_month_year varchar as split_part(substr(metadata$filename, 15), '.', 0)
+)
+partition by (file_month_year)
+with location = @stage_gcp_listings
+file_format = file_format_parquet
+pattern = '.*[.]parquet';
+
+create or replace external table raw.go1_census
+with location = @stage_gcp_census_lga
+file_format = file_format_parquet
+pattern = '.*2016Census_G01_NSW_LGA[.]parquet';
+
+create or replace external table raw.go2_census
+with location = @stage_gcp_census_lga
+file_format = file_format_parquet
+pattern = '.*2016Census_G02_NSW_LGA[.]parquet';
+
+-- Check the row counts of the Parquet external tables
+select count(*) from raw.listings;
+select count(*) from raw.go1_census;
+select count(*) from raw.go2_census;
+
+------- MULTI-CITY INGESTION --------
+
+-- Run this block once for every other city of BDE_CITIES, shown here for melbourne. The city's listings files
+-- are uploaded to the data/listings_melbourne folder of the bucket and loaded into its own suffixed schemas,
+-- the lga, suburb and census tables and dim_lga, dim_suburb and dim_date are shared with sydney.
+-- The partition column takes the month from the file name whatever the length of the folder name.
+create schema raw_melbourne;
+create schema staging_melbourne;
+create schema datawarehouse_melbourne;
+create schema datamart_melbourne;
+
+create or replace stage stage_gcp_listings_melbourne
+storage_integration = GCP
+url='gcs://australia-southeast1-bde-at-c3328733-bucket/data/listings_melbourne/'
+;
+
+create or replace external table raw_melbourne.listings (
+    file_month_year varchar as split_part(split_part(metadata$filename, '/', -1), '.', 0)
+)
+partition by (file_month_year)
+with location = @stage_gcp_listings_melbourne
+file_format = file_format_csv
+pattern = '.*[.]csv';
+
+-- Check the row count of the external table: raw_melbourne.listings
+select count(*) from raw_melbourne.listings;
+
 -- Create schemas for staging, warehouse and datamart layers
 Create schema staging;
 create schema datawarehouse;
@@ -388,41 +476,61 @@ review_scores_ratings
 from datawarehouse.temp_listings_lga_suburb;
 
 ---- Adding primary key constraints to the dimension tables
-alter table datawarehouse.dim_date add primary key (date_id);
-alter table datawarehouse.dim_host add primary key (auto_gen_host_id);
-alter table datawarehouse.dim_lga add primary key (lga_code);
-alter table datawarehouse.dim_listings add primary key(auto_gen_listing_id);
-alter table datawarehouse.dim_suburb add primary key(suburb_id);
+---- Snowflake does not enforce them: they are declared NOT ENFORCED with RELY so that the optimizer can use them,
+---- and the DAG checks the loaded fact rows against them in validate_referential_integrity_task
+alter table datawarehouse.dim_date add primary key (date_id) not enforced rely;
+alter table datawarehouse.dim_host add primary key (auto_gen_host_id) not enforced rely;
+alter table datawarehouse.dim_lga add primary key (lga_code) not enforced rely;
+alter table datawarehouse.dim_listings add primary key(auto_gen_listing_id) not enforced rely;
+alter table datawarehouse.dim_suburb add primary key(suburb_id) not enforced rely;
 
 -- Adding foreign key constraint for auto_gen_listing_id to fact_listings table
 alter table datawarehouse.fact_listings
 add constraint fact_listings_fk_dim_listings
 foreign key (auto_gen_listing_id)
-references datawarehouse.dim_listings (auto_gen_listing_id);
+references datawarehouse.dim_listings (auto_gen_listing_id)
+not enforced rely;
 
 -- Adding foreign key constraint for auto_gen_host_id to fact_listings table
 alter table datawarehouse.fact_listings
 add constraint fact_listings_fk_dim_host
 foreign key (auto_gen_host_id)
-references datawarehouse.dim_host (auto_gen_host_id);
+references datawarehouse.dim_host (auto_gen_host_id)
+not enforced rely;
 
 -- Adding foreign key constraint for lga_code to fact_listings table
 alter table datawarehouse.fact_listings
 add constraint fact_listings_fk_dim_lga
 foreign key (lga_code)
-references datawarehouse.dim_lga (lga_code);
+references datawarehouse.dim_lga (lga_code)
+not enforced rely;
 
 -- Adding foreign key constraint for suburb_id to fact_listings table
 alter table datawarehouse.fact_listings
 add constraint fact_listings_fk_dim_suburb
 foreign key (suburb_id)
-references datawarehouse.dim_suburb (suburb_id);
+references datawarehouse.dim_suburb (suburb_id)
+not enforced rely;
 
 -- Adding foreign key constraint for date_id to fact_listings table
 alter table datawarehouse.fact_listings
 add constraint fact_listings_fk_dim_date
 foreign key (date_id)
-references datawarehouse.dim_date (date_id);
+references datawarehouse.dim_date (date_id)
+not enforced rely;
+
+-- The DAG declares these constraints in its table DDL. Tables created by earlier versions of the DAG
+-- declared them without RELY, set it once on the existing constraints
+alter table datawarehouse.dim_listings alter primary key (auto_gen_listing_id) rely;
+alter table datawarehouse.dim_host alter primary key (auto_gen_host_id) rely;
+alter table datawarehouse.dim_lga alter primary key (lga_code) rely;
+alter table datawarehouse.dim_suburb alter primary key (suburb_id) rely;
+alter table datawarehouse.dim_date alter primary key (date_id) rely;
+alter table datawarehouse.fact_listings alter constraint fact_listings_fk_dim_listings (auto_gen_listing_id) rely;
+alter table datawarehouse.fact_listings alter constraint fact_listings_fk_dim_host (auto_gen_host_id) rely;
+alter table datawarehouse.fact_listings alter constraint fact_listings_fk_dim_lga (lga_code) rely;
+alter table datawarehouse.fact_listings alter constraint fact_listings_fk_dim_suburb (suburb_id) rely;
+alter table datawarehouse.fact_listings alter constraint fact_listings_fk_dim_date (date_id) rely;
 
 
 -------- DATA MART LAYER -------
@@ -544,6 +652,10 @@ estimated_revenue_active_listing/distinct_hosts as estimated_revenue_per_host
 from host_neighbourhood_stats
 ;
 
+-- The part 3 analyses are tables refreshed by the DAG, drop the views of earlier versions once before its next run
+drop view if exists datamart.hosts_lga_same_as_listing_lga;
+drop view if exists datamart.hosts_can_cover_mortgage;
+
 -- Viewing the datamart tables
 select * from datamart.dm_listing_neighbourhood order by listing_neighbourhood, month_year;
 select * from datamart.dm_property_type order by property_type, room_type, accomodates, month_year;
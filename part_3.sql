@@ -81,54 +81,10 @@ order by estimated_revenue_per_active_listing desc;
 
 -- Part 3c
 -- Do hosts with multiple listings have their listings in the same LGA as they live?
--- create a cte to find hosts with multiple listings
--- create another cte to find hosts and their lga
--- create another cte to find the listings cte for each host
--- join the three ctes to find if the host lga is same as the listing lga and create a temporary view
-create or replace view datamart.hosts_lga_same_as_listing_lga as 
-with hosts_multiple_listings as (
-    select 
-    original_host_id,
-    count(distinct(original_listing_id)) as num_listings
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    group by original_host_id
-    having num_listings > 1
-),
-hosts_lga as (
-    select 
-    lga_name as host_lga,
-    datawarehouse.dim_host.auto_gen_host_id,
-    original_host_id,
-    suburb_name
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    left join datawarehouse.dim_suburb on datawarehouse.fact_listings.suburb_id = datawarehouse.dim_suburb.suburb_id
-    where suburb_name is not null
-),
-listings_lga as (
-    select
-    datawarehouse.dim_host.auto_gen_host_id,
-    original_host_id,
-    original_listing_id,
-    lga_name as listing_lga
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
-)
-select 
-distinct(hosts_lga.auto_gen_host_id),
-hosts_lga.original_host_id,
-host_lga,
-listing_lga,
-case when host_lga = listing_lga then TRUE else FALSE END as hosts_lga_same_as_listing_lga,
-num_listings
-from hosts_lga
-inner join listings_lga on hosts_lga.auto_gen_host_id = listings_lga.auto_gen_host_id
-inner join hosts_multiple_listings on hosts_lga.original_host_id = hosts_multiple_listings.original_host_id;
+-- datamart.hosts_lga_same_as_listing_lga is a table clustered on the listing lga, refreshed by
+-- refresh_datamart_hosts_lga_same_as_listing_lga_task for the hosts with listings in the loaded months (see bde_at3_sql.py):
+-- hosts with multiple listings, the lga of each host and the lga of each host's listings are joined to find
+-- if the host lga is same as the listing lga
 
 -- view datamart.hosts_lga_same_as_listing_lga
 select * from datamart.hosts_lga_same_as_listing_lga;
@@ -142,41 +98,9 @@ group by hosts_lga_same_as_listing_lga;
 
 -- Part 3d
 -- Can hosts with a unique listing cover the annualised median mortgage repayment with their estimated revenue?
--- create a cte with the annual revenue for each host
--- create a cte with annualised mortgage repayment for each host's listing neighbourhood 
--- join the two ctes together to find if the hosts can cover the annualised mortgage repayment and create a temporary view
-create or replace view datamart.hosts_can_cover_mortgage as
-with hosts_annual_revenue as (
-    select 
-    original_host_id,
-    count(distinct(original_listing_id)) as num_listings,
-    sum(case when has_availability = TRUE then ((30-availability_30)*price) END) as estimated_annual_revenue
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
-    left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    group by original_host_id
-    having num_listings = 1
-),
-annualised_mortgage_revenue as (
-    select
-    distinct original_host_id,
-    lga_name as listing_neighbourhood,
-    median_mortgage_repay_monthly*12 as annualised_median_mortgage
-    from datawarehouse.fact_listings
-    left join datawarehouse.dim_lga on datawarehouse.fact_listings.lga_code = datawarehouse.dim_lga.lga_code
-    left join datawarehouse.dim_listings on datawarehouse.fact_listings.auto_gen_listing_id= datawarehouse.dim_listings.auto_gen_listing_id
-    left join datawarehouse.dim_host on datawarehouse.fact_listings.auto_gen_host_id = datawarehouse.dim_host.auto_gen_host_id
-    order by annualised_median_mortgage
-)
-select 
-hosts_annual_revenue.original_host_id, 
-listing_neighbourhood,
-estimated_annual_revenue,
-annualised_median_mortgage,
-estimated_annual_revenue >= annualised_median_mortgage as can_cover_mortgage
-from hosts_annual_revenue
-inner join annualised_mortgage_revenue on hosts_annual_revenue.original_host_id = annualised_mortgage_revenue.original_host_id;
+-- datamart.hosts_can_cover_mortgage is a table clustered on the listing neighbourhood, refreshed by
+-- refresh_datamart_hosts_can_cover_mortgage_task for the hosts with listings in the loaded months (see bde_at3_sql.py):
+-- the annual revenue of each host is joined with the annualised mortgage repayment of the host's listing neighbourhood
 
 -- view datamart.hosts_can_cover_mortgage
 select * from datamart.hosts_can_cover_mortgage;
@@ -0,0 +1,16 @@
+import pytest
+
+from bde_at3_census import census_file_columns, census_packs, infer_file_columns
+
+
+#########################################################
+#
+#   Tests
+#
+#########################################################
+
+@pytest.mark.parametrize("table", list(census_packs))
+def test_census_schema_matches_files(table):
+    # The committed schema that the DAG reads must be rewritten whenever a census file changes
+    file_name = census_packs[table]["file_name"]
+    assert census_file_columns(file_name) == infer_file_columns(file_name)
@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import duckdb
+import pytest
+
+from bde_at3_benchmark import generate_listings
+from bde_at3_duckdb import LocalWarehouse, default_data_dir
+from bde_at3_sql import table_tasks
+
+
+#########################################################
+#
+#   Test Settings
+#
+#########################################################
+
+test_months = ["05_2020", "06_2020", "07_2020"]
+
+# Fraction of the Sydney volume generated per month
+test_scale = 0.01
+
+
+#########################################################
+#
+#   Tests
+#
+#########################################################
+
+@pytest.fixture
+def listings_dir(tmp_path):
+    generate_listings(str(tmp_path), scale=test_scale, months=test_months)
+    return tmp_path
+
+
+def set_line_endings(path, line_ending):
+    with open(path, "rb") as f:
+        content = f.read().replace(b"\r\n", b"\n")
+    with open(path, "wb") as f:
+        f.write(content.replace(b"\n", line_ending))
+
+
+@pytest.mark.parametrize("line_endings", [[b"\n", b"\r\n", b"\r\n"], [b"\r\n", b"\n", b"\r\n"]])
+def test_listings_files_with_mixed_line_endings_load_every_row(listings_dir, line_endings):
+    for month, line_ending in zip(test_months, line_endings):
+        set_line_endings(os.path.join(listings_dir, f"{month}.csv"), line_ending)
+    warehouse = LocalWarehouse(listings_dir=str(listings_dir))
+    rows = dict(warehouse.conn.execute("select file_month_year, count(*) from raw.listings group by 1").fetchall())
+    for month in test_months:
+        with open(os.path.join(listings_dir, f"{month}.csv"), "rb") as f:
+            assert rows.get(month) == f.read().count(b"\n") - 1
+
+
+def test_file_without_rows_fails_the_refresh(listings_dir):
+    warehouse = LocalWarehouse(listings_dir=str(listings_dir))
+    with pytest.raises(ValueError, match="read 0 rows"):
+        warehouse.check_file_rows("raw", "listings", {"data/listings/08_2020.csv": 10})
+
+
+def test_failed_dimension_is_built_again_by_the_next_run(listings_dir, tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("data") / "data"
+    shutil.copytree(default_data_dir, data_dir)
+    warehouse = LocalWarehouse(data_dir=str(data_dir), listings_dir=str(listings_dir))
+    warehouse.run_dag(skip_unchanged=True)
+
+    lga_code_path = data_dir / "NSW_LGA" / "NSW_LGA_CODE.csv"
+    lga_code_path.write_text(lga_code_path.read_text().replace("10050,Albury\n", "10050,Albury City\n"))
+    warehouse.refresh_external_table("nsw_lga_code")
+    failing_tasks = dict(table_tasks)
+    failing_tasks["dim_lga"] = ("select * from missing_table;\n" + table_tasks["dim_lga"][0], table_tasks["dim_lga"][1])
+    with pytest.raises(duckdb.CatalogException):
+        warehouse.run_dag(failing_tasks, skip_unchanged=True)
+
+    # The lga code files were not recorded as loaded, so the next run stages them and builds dim_lga again
+    warehouse.run_dag(skip_unchanged=True)
+    assert warehouse.conn.execute("select lga_name from datawarehouse.dim_lga where lga_code = 10050").fetchone() == (
+        "Albury City",
+    )
+    assert warehouse.run_dag(skip_unchanged=True) == []
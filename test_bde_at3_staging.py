@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from bde_at3_benchmark import generate_listings
+from bde_at3_census import census_packs
+from bde_at3_duckdb import LocalWarehouse
+from bde_at3_sql import census_staging_sql, query_refresh_staging_listings
+
+
+#########################################################
+#
+#   Test Settings
+#
+#########################################################
+
+part_1_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "part_1.sql")
+
+test_months = ["05_2020", "06_2020", "07_2020"]
+
+# Fraction of the Sydney volume generated per month
+test_scale = 0.02
+
+staging_tables = ["listings", *census_packs]
+
+# The census columns typed from the csv values keep the decimals that the baseline int cast rounded
+widened_types = {("INTEGER", "FLOAT")}
+
+
+#########################################################
+#
+#   Baseline and Generated Staging Tables
+#
+#########################################################
+
+def baseline_staging_sql():
+    # The multi-pass staging layer of part_1.sql: a CTAS per table, then a second CTAS for the derived columns
+    # and the drop and rename column chain of staging.listings
+    with open(part_1_path) as f:
+        sql = f.read()
+    start = sql.index("------- STAGING LAYER --------")
+    return sql[start:sql.index("\n------", start + 1)]
+
+
+@pytest.fixture(scope="module")
+def warehouse(tmp_path_factory):
+    listings_dir = tmp_path_factory.mktemp("listings")
+    generate_listings(str(listings_dir), scale=test_scale, months=test_months)
+    warehouse = LocalWarehouse(listings_dir=str(listings_dir))
+
+    # Keep the baseline tables aside, then build the same tables with the SQL of the DAG on the same files
+    warehouse.run_task("baseline_staging", baseline_staging_sql())
+    warehouse.conn.execute("create schema baseline")
+    for table in staging_tables:
+        warehouse.conn.execute(f"create table baseline.{table} as select * from staging.{table}")
+        warehouse.conn.execute(f"drop table staging.{table}")
+    for table in census_packs:
+        warehouse.run_task(f"refresh_staging_{table}_task", census_staging_sql(table))
+    warehouse.run_task("refresh_staging_listings_task", query_refresh_staging_listings)
+    return warehouse
+
+
+def table_columns(warehouse, schema, table):
+    # Snowflake folds the unquoted column names of both tables to upper case, so their case is not compared
+    return warehouse.conn.execute("""
+        select lower(column_name), data_type
+        from information_schema.columns
+        where table_schema = ? and table_name = ?
+        order by ordinal_position
+    """, [schema, table]).fetchall()
+
+
+def missing_rows(warehouse, table, baseline_columns, columns):
+    # Rows of the baseline table missing from the generated table and the other way round, duplicates included
+    baseline_select = f"select {', '.join(baseline_columns)} from baseline.{table}"
+    select = f"select {', '.join(columns)} from staging.{table}"
+    return [
+        warehouse.conn.execute(f"select count(*) from ({left} except all {right})").fetchone()[0]
+        for left, right in ((baseline_select, select), (select, baseline_select))
+    ]
+
+
+#########################################################
+#
+#   Tests
+#
+#########################################################
+
+def test_listings_schema_matches_baseline(warehouse):
+    assert table_columns(warehouse, "staging", "listings") == table_columns(warehouse, "baseline", "listings")
+
+
+def test_listings_rows_match_baseline(warehouse):
+    columns = [name for name, data_type in table_columns(warehouse, "baseline", "listings")]
+    assert warehouse.conn.execute("select count(*) from staging.listings").fetchone()[0] > 0
+    assert missing_rows(warehouse, "listings", columns, columns) == [0, 0]
+
+
+@pytest.mark.parametrize("table", list(census_packs))
+def test_census_columns_match_baseline(warehouse, table):
+    # The generated census tables keep only the columns used downstream, each with its baseline type
+    baseline_types = dict(table_columns(warehouse, "baseline", table))
+    columns = table_columns(warehouse, "staging", table)
+    assert columns
+    for name, data_type in columns:
+        assert name in baseline_types
+        assert data_type == baseline_types[name] or (baseline_types[name], data_type) in widened_types
+
+
+@pytest.mark.parametrize("table", list(census_packs))
+def test_census_rows_match_baseline(warehouse, table):
+    baseline_types = dict(table_columns(warehouse, "baseline", table))
+    columns = table_columns(warehouse, "staging", table)
+    # A widened column holds the value that the baseline rounded to an int
+    selected = [
+        f"round({name})::{baseline_types[name]}" if data_type != baseline_types[name] else name
+        for name, data_type in columns
+    ]
+    assert warehouse.conn.execute(f"select count(*) from staging.{table}").fetchone()[0] > 0
+    assert missing_rows(warehouse, table, [name for name, data_type in columns], selected) == [0, 0]